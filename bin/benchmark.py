@@ -0,0 +1,397 @@
+#!/usr/bin/python # -*- mode: python; python-indent-offset: 4 -*-
+#
+# Benchmark the hot paths of the airspace pipeline on the given
+# OpenAir file and on synthetic files with 10x and 100x as many
+# records, store the results as JSON and compare them with a baseline.
+#
+# The synthetic files consist of copies of the given file, each moved
+# by whole degrees, so that the copies do not overlap each other.
+# The run stops, if check-consistency.py -e reports more errors on a
+# synthetic file than on the given file.
+#
+# Parse, resolveRecordArcs (with and without --fast-arc or --arc-tolerance),
+# createPolygons and find_under are measured in this process with
+# common.Profiler. The checks are measured by running
+# check-consistency.py --profile.
+#
+
+import argparse
+import decimal
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import shapely
+
+import common
+
+COORDINATE = re.compile(
+    r'(\d+):(\d+):(\d+(?:\.\d+)?)(\s*)([NS])(\s*)(\d+):(\d+):(\d+(?:\.\d+)?)(\s*)([EW])')
+
+# Latitude rows of the copies in a synthetic file, in units of the
+# height of the file (0 first). Within a row the copies are placed side
+# by side in longitude.
+LAT_ROWS = [0, -1, 1, -2, 2]
+
+# Tolerance in m of the --arc-tolerance benchmarks
+ARC_TOLERANCE = 10
+
+CHECK_PHASES = {
+    "checkOverlappingAirspaces": "getOverlappingAirspaces",
+    "checkPoints": "checkPoints",
+    "checkCircles": "checkCircles",
+}
+
+
+def toSeconds(degrees, minutes, seconds, hemisphere):
+    """
+    @return coordinate in exact seconds, negative for S and W
+    """
+    value = int(degrees) * 3600 + int(minutes) * 60 + decimal.Decimal(seconds)
+    return -value if hemisphere in "SW" else value
+
+
+def fromSeconds(value, width, hemispheres):
+    """
+    @return degrees, minutes, seconds and the hemisphere of the
+    coordinate value given in seconds
+    """
+    hemisphere = hemispheres[1] if value < 0 else hemispheres[0]
+    (minutes, seconds) = divmod(abs(value), 60)
+    (degrees, minutes) = divmod(int(minutes), 60)
+    (whole, fraction) = str(seconds).partition(".")[::2]
+    seconds = f'{int(whole):02d}' + (f'.{fraction}' if fraction else "")
+    return (f'{degrees:0{width}d}', f'{minutes:02d}', seconds, hemisphere)
+
+
+def extent(lines):
+    """
+    @return (lat_min, lon_min, lat_max, lon_max) of all coordinates
+    """
+    coords = [common.parseCoordinate(match.group(0))
+              for line in lines if isCoordinateLine(line)
+              for match in COORDINATE.finditer(line)]
+    return (*np.min(coords, axis=0), *np.max(coords, axis=0))
+
+
+def copyOffsets(lines, count):
+    """
+    Place count copies of the file without overlapping each other.
+
+    A copy moved by whole degrees of longitude keeps all distances and
+    bearings, so the copies are put side by side in longitude. Only if
+    a row around the earth is full, further rows are moved in latitude.
+
+    @return list of (lat, lon) offsets in whole degrees of count
+    copies, the first one is the original
+    """
+    (lat_min, lon_min, lat_max, lon_max) = extent(lines)
+    height = math.floor(lat_max - lat_min) + 1
+    width = math.floor(lon_max - lon_min) + 1
+
+    # Offsets, that keep the copy between -180 and 180 degrees
+    lons = range(-math.floor((180 + lon_min) / width) * width,
+                 math.floor((180 - lon_max) / width) * width + 1, width)
+    lons = sorted(lons, key=abs)
+    offsets = [(row * height, lon) for row in LAT_ROWS for lon in lons
+               if -85 < lat_min + row * height and lat_max + row * height < 85]
+    if count > len(offsets):
+        raise ValueError(f'At most {len(offsets)} copies are possible')
+    return offsets[:count]
+
+
+def isCoordinateLine(line):
+    return line[:2] in ["DP", "DB"] or line.startswith("V X")
+
+
+def moveCoordinate(match, dlat, dlon, lon_center, stretch):
+    """
+    Move the coordinate matched by COORDINATE by dlat and dlon degrees.
+
+    A degree of longitude has another length at another latitude, so
+    the distance in degrees to lon_center is multiplied by stretch to
+    keep the shape of the airspaces.
+
+    @return the moved coordinate in the format of the match
+    """
+    g = list(match.groups())
+    lat = toSeconds(g[0], g[1], g[2], g[4])
+    lon = toSeconds(g[6], g[7], g[8], g[10])
+    if stretch != 1:
+        lon = lon_center * 3600 + (float(lon) - lon_center * 3600) * stretch
+        lon = decimal.Decimal(lon).quantize(decimal.Decimal("0.01"))
+    (g[0], g[1], g[2], g[4]) = fromSeconds(lat + dlat * 3600, 2, "NS")
+    (g[6], g[7], g[8], g[10]) = fromSeconds(lon + dlon * 3600, 3, "EW")
+    return f'{g[0]}:{g[1]}:{g[2]}{g[3]}{g[4]}{g[5]}{g[6]}:{g[7]}:{g[8]}{g[9]}{g[10]}'
+
+
+def arcCenter(center, start, end):
+    """
+    The stretch of a copy is only exact at one latitude, so the start
+    and end of a moved arc have slightly different distances to its
+    moved center. Move the center onto the perpendicular bisector of
+    start and end instead of changing the points shared with the
+    neighbouring airspaces.
+
+    @return the center, which is equidistant to start and end, as
+    OpenAir coordinate
+    """
+    (kx, ky) = common.get_kx_ky(center[0])
+    a = np.array([(start[1] - center[1]) * kx, (start[0] - center[0]) * ky])
+    b = np.array([(end[1] - center[1]) * kx, (end[0] - center[0]) * ky])
+    d = b - a
+    (x, y) = d * np.dot((a + b) / 2, d) / np.dot(d, d)
+    (lat, lon) = (center[0] + y / ky, center[1] + x / kx)
+    seconds = decimal.Decimal("0.01")
+    lat = fromSeconds(decimal.Decimal(lat * 3600).quantize(seconds), 2, "NS")
+    lon = fromSeconds(decimal.Decimal(lon * 3600).quantize(seconds), 3, "EW")
+    return f'{lat[0]}:{lat[1]}:{lat[2]} {lat[3]} {lon[0]}:{lon[1]}:{lon[2]} {lon[3]}'
+
+
+def writeScaledFile(filename, filename_scaled, scale):
+    """
+    Write a synthetic OpenAir file with scale copies of all airspaces
+    of the given file (see copyOffsets()).
+    """
+    with open(filename, encoding='latin-1', newline='') as fp:
+        lines = fp.readlines()
+    if not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    (lat_min, lon_min, lat_max, lon_max) = extent(lines)
+    (lat_center, lon_center) = ((lat_min + lat_max) / 2, (lon_min + lon_max) / 2)
+
+    with open(filename_scaled, "w", encoding='latin-1', newline='') as fp:
+        for (copy, (dlat, dlon)) in enumerate(copyOffsets(lines, scale)):
+            stretch = 1
+            if dlat != 0:
+                (kx, _) = common.get_kx_ky(lat_center)
+                (kx_moved, _) = common.get_kx_ky(lat_center + dlat)
+                stretch = kx / kx_moved
+            center_line = None
+            for line in lines:
+                if copy > 0:
+                    if line.startswith("AN "):
+                        line = line.rstrip("\r\n") + f' #{copy}\n'
+                    elif isCoordinateLine(line):
+                        line = COORDINATE.sub(
+                            lambda match: moveCoordinate(match, dlat, dlon, lon_center, stretch), line)
+                if line.startswith("V X"):
+                    center_line = line
+                elif line.startswith("DB") and stretch != 1:
+                    (start, end) = [common.parseCoordinate(match.group(0))
+                                    for match in COORDINATE.finditer(line)]
+                    center = common.parseCoordinate(
+                        COORDINATE.search(center_line).group(0))
+                    fp.write(f'V X={arcCenter(center, start, end)}\n')
+                    fp.write(line)
+                    line = center_line
+                fp.write(line)
+
+
+def countErrors(filename):
+    """
+    @return number of errors check-consistency.py -e reports for the file
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "check-consistency.py"),
+               "-e", filename]
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            encoding='latin-1').stdout
+    return sum(1 for line in output.splitlines() if line.startswith("ERR"))
+
+
+def loadProfiled(filename, fast_arc, arc_tolerance=None):
+    """
+    Load the file with a fresh common.Profiler.
+
+    @return (records, profiler)
+    """
+    common.setArgs(argparse.Namespace(no_arc=False, fast_arc=fast_arc,
+                                      arc_tolerance=arc_tolerance,
+                                      cache_dir=None, errors_only=True))
+    common.profiler = common.Profiler(memory=args.memory)
+    records = common.loadAirspace(filename)
+    with common.collectProblems():
+        common.checkHeights(records)
+    return (records, common.profiler)
+
+
+def benchmarkFindUnder(records, count):
+    """
+    Look up count random points like visualize.find_under() does: the
+    index is built on the first lookup.
+    """
+    polygons = [record["polygon"] for record in records if "polygon" in record]
+    (lat_min, lon_min, lat_max, lon_max) = shapely.total_bounds(polygons)
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(lat_min, lat_max, count).tolist()
+    lons = rng.uniform(lon_min, lon_max, count).tolist()
+
+    with common.profilePhase("find_under"):
+        index = common.AirspaceIndex(records)
+        hits = 0
+        for (lat, lon) in zip(lats, lons):
+            hits += len(index.find(lat, lon))
+        common.profileCount("lookups", count)
+        common.profileCount("hits", hits)
+
+
+def runChecks(filename):
+    """
+    Run check-consistency.py --profile on the file.
+
+    @return list of the profiled phases
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        profile = os.path.join(tmpdir, "profile.json")
+        command = [sys.executable, os.path.join(os.path.dirname(__file__), "check-consistency.py"),
+                   "-e", "-o", "--profile", profile, filename]
+        if not args.memory:
+            command.append("--profile-no-memory")
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        if not os.path.exists(profile):
+            raise RuntimeError(f'check-consistency.py failed on {filename}')
+        with open(profile) as fp:
+            return json.load(fp)["phases"]
+
+
+def result(phase):
+    return {"wall": phase["wall"], "cpu": phase["cpu"],
+            "peak_bytes": phase["peak_bytes"], "counts": phase["counts"]}
+
+
+def benchmarkFile(filename):
+    """
+    @return dict of the name of every benchmark to its result
+    """
+    results = {}
+
+    (records, profiler) = loadProfiled(filename, fast_arc=False)
+    benchmarkFindUnder(records, args.lookups)
+    for phase in profiler.phases.values():
+        if phase["name"] in ["parse", "resolveRecordArcs", "createPolygons", "find_under"]:
+            results[phase["name"]] = result(phase)
+
+    (records, profiler) = loadProfiled(filename, fast_arc=True)
+    phase = profiler.phases["resolveRecordArcs"]
+    results["resolveRecordArcs --fast-arc"] = result(phase)
+
+    (records, profiler) = loadProfiled(filename, fast_arc=False,
+                                       arc_tolerance=ARC_TOLERANCE)
+    for name in ["resolveRecordArcs", "createPolygons"]:
+        results[f'{name} --arc-tolerance'] = result(profiler.phases[name])
+    common.profiler = None
+
+    for phase in runChecks(filename):
+        if phase["name"] in CHECK_PHASES:
+            results[CHECK_PHASES[phase["name"]]] = result(phase)
+
+    return results
+
+
+def best(runs):
+    """
+    @return the run with the lowest wall time for every benchmark
+    """
+    return {name: min((run[name] for run in runs), key=lambda r: r["wall"])
+            for name in runs[0]}
+
+
+def compare(results, baseline):
+    """
+    Print all results compared with the baseline.
+
+    @return number of regressions
+    """
+    regressions = 0
+    print(f'{"file":8} {"benchmark":34} {"baseline s":>10} {"now s":>10} {"ratio":>6}')
+    for (scale, benchmarks) in results.items():
+        for (name, now) in benchmarks.items():
+            before = baseline.get(scale, {}).get(name)
+            if before == None:
+                print(f'{scale:8} {name:34} {"-":>10} {now["wall"]:10.3f}')
+                continue
+            ratio = now["wall"] / before["wall"] if before["wall"] > 0 else 1
+            slower = now["wall"] - before["wall"]
+            regression = ratio > args.threshold and slower > args.min_time
+            if regression:
+                regressions += 1
+            print(f'{scale:8} {name:34} {before["wall"]:10.3f} {now["wall"]:10.3f} {ratio:6.2f}'
+                  f'{"  REGRESSION" if regression else ""}')
+    return regressions
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the airspace pipeline on an OpenAir file and on scaled synthetic copies')
+parser.add_argument("-s", "--scale", type=int, nargs="+", default=[1, 10, 100],
+                    help="Number of copies of the file to benchmark (default 1 10 100)")
+parser.add_argument("-r", "--repeat", type=int, default=1,
+                    help="Run every benchmark this often and keep the fastest run")
+parser.add_argument("-l", "--lookups", type=int, default=10000,
+                    help="Number of random points looked up by find_under")
+parser.add_argument("-m", "--memory", action="store_true",
+                    help="Measure the peak memory by tracemalloc (slows down some benchmarks)")
+parser.add_argument("-o", "--output", default="benchmark.json",
+                    help="Write the results into this JSON file (default benchmark.json)")
+parser.add_argument("-b", "--baseline",
+                    help="Compare the results with this JSON file written before")
+parser.add_argument("-t", "--threshold", type=float, default=1.25,
+                    help="Report a regression if a benchmark is slower than the baseline by this factor (default 1.25)")
+parser.add_argument("--min-time", type=float, default=0.05,
+                    help="Ignore regressions of less than this many seconds (default 0.05)")
+parser.add_argument("--work-dir",
+                    help="Keep the synthetic files in this directory instead of a temporary one")
+parser.add_argument("filename", nargs="?",
+                    default=os.path.join(os.path.dirname(__file__), "..",
+                                         "source", "airspace_germany.txt"),
+                    help="OpenAir file (default source/airspace_germany.txt)")
+args = parser.parse_args()
+
+results = {}
+errors = None
+with tempfile.TemporaryDirectory() as tmpdir:
+    work_dir = args.work_dir or tmpdir
+    os.makedirs(work_dir, exist_ok=True)
+    for scale in args.scale:
+        if scale == 1:
+            filename = args.filename
+        else:
+            filename = os.path.join(work_dir, f'scaled-{scale}x.txt')
+            writeScaledFile(args.filename, filename, scale)
+            # The copies must not break any airspace
+            if errors == None:
+                errors = countErrors(args.filename)
+            errors_scaled = countErrors(filename)
+            if errors_scaled > errors:
+                raise RuntimeError(f'{filename} has {errors_scaled} errors, '
+                                   f'but {args.filename} only {errors}')
+        print(f'Benchmarking {filename}', file=sys.stderr)
+        start = time.perf_counter()
+        results[f'{scale}x'] = best([benchmarkFile(filename)
+                                     for _ in range(args.repeat)])
+        print(f'  done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+with open(args.output, "w") as fp:
+    json.dump({
+        "filename": args.filename,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }, fp, indent=1)
+    fp.write("\n")
+
+baseline = {}
+if args.baseline:
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)["results"]
+regressions = compare(results, baseline)
+
+sys.exit(1 if regressions > 0 else 0)
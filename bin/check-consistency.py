@@ -5,6 +5,11 @@ from pprint import pprint
 import math
 import io
 import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import multiprocessing
 import sys
 from datetime import datetime
 import os
@@ -12,165 +17,315 @@ import common
 from shapely.geometry import Polygon, LineString
 from shapely.validation import explain_validity
 import shapely
+import numpy as np
 import re
 from icecream import ic
 
 
 def findLatLon(p):
-    global records
+    """
+    Find all elements using exactly the given point.
+
+    @return list of (record, element, lineno)
+    """
+    global coordinates
+
+    return coordinates.get(tuple(p), [])
+
 
-    elements = []
+def collectCircles(records):
+    """
+    Collect the centers of all circles (DC) in the order of the file.
+
+    @return list of (record, center)
+    """
+
+    circles = []
     for record in records:
         for element in record["elements"]:
             if element["type"] == "circle":
-                if element["center"] == p:
-                    elements.append(element)
-            if element["type"] == "point":
-                if element["location"] == p:
-                    elements.append(element)
-            if element["type"] == "arc":
-                if element["start"] == p:
-                    elements.append(element)
-                if element["end"] == p:
-                    elements.append(element)
-    return elements
+                circles.append((record, element["center"]))
+    return circles
 
 
-def findNearCircles(record_base, element_base):
-    global records
+def findClose(p1, locations, grid):
+    """
+    Find all locations closer than args.distance to p1, but not identical.
+
+    @param grid common.PointGrid of the locations
+    @return list of (index into locations, distance in m), sorted by index
+    """
     global args
-    for record in records:
-        for element in record["elements"]:
-            if element["type"] == "circle":
-                if element != element_base:
-                    (distance_m, bearing) = common.geo_distance(element_base["center"][0], element_base["center"][1],
-                                                                element["center"][0], element["center"][1])
-                    # convert cm to m
-                    distance_m = int(distance_m / 100)
-                    if distance_m > 0 and distance_m < args.distance:
-                        findingForTwoPoints(
-                            f'Airspaces with near circles ({distance_m}m)', record_base, record, element_base["center"], element["center"])
+
+    close = []
+    candidates = grid.query(p1[0], p1[1])
+    common.profileCount("distance evaluations", len(candidates))
+    for k in candidates:
+        p2 = locations[k]
+        (distance_m, bearing) = common.geo_distance(
+            p1[0], p1[1], p2[0], p2[1])
+        distance_m = distance_m / 100        # convert cm to m
+        if distance_m > 0 and distance_m < args.distance:
+            close.append((k, distance_m))
+    return close
 
 
-def checkCircles(records):
+def reportNearCircles(record_base, center, close, circles):
+    """
+    Report the near circles found by findClose().
+
+    @return number of suppressed duplicate findings
+    """
+
+    suppressed = 0
+    for (k, distance_m) in close:
+        (record, center2) = circles[k]
+        distance_m = int(distance_m)
+        if distance_m > 0:
+            if not findingForTwoPoints(
+                    f'Airspaces with near circles ({distance_m}m)', record_base, record, center, center2):
+                suppressed += 1
+    return suppressed
+
+
+def prepareCircles(records):
+    """
+    Collect all circles (see collectCircles()) and build the
+    common.PointGrid of their centers.
+
+    @return (circles, centers, grid)
+    """
+
+    circles = collectCircles(records)
+    centers = [center for (_, center) in circles]
+    return (circles, centers, common.PointGrid(centers, args.distance))
+
+
+def checkCircles(records, start=0, end=None, prepared=None):
     """
     Walk through all center points and check, if there are close center points, that are not identical.
+    Only the circles start to end (see collectCircles()) are compared with all others.
+
+    @param prepared result of prepareCircles(records), if already built
+    @return number of suppressed duplicate findings
     """
 
-    for record in records:
-        # pprint(record)
-        # print("Checking", record["name"])
-        for element in record["elements"]:
-            if element["type"] == "circle":
-                # pprint(element)
-                findNearCircles(record, element)
+    (circles, centers, grid) = prepared or prepareCircles(records)
+    suppressed = 0
+    for (record, center) in circles[start:end]:
+        suppressed += reportNearCircles(record, center,
+                                        findClose(center, centers, grid), circles)
+    return suppressed
+
+
+def printSuppressed(check, suppressed):
+    global args
+
+    if suppressed > 0 and not args.errors_only:
+        print(f'{check}: {suppressed} duplicate findings suppressed',
+              file=common.infoFile())
+
+
+def findingKey(message, record1, record2, p1, p2):
+    """
+    Create a hashable key for a finding, which is independent of the
+    order of the two records and of the two points.
+    """
+    records_key = tuple(sorted((id(record1), id(record2))))
+    points_key = tuple(sorted((tuple(round(v, 9) for v in p1),
+                               tuple(round(v, 9) for v in p2))))
+    return (message, records_key, points_key)
 
 
 def findingForTwoPoints(message, record1, record2, p1, p2):
+    """
+    Report a problem between two points of two records, if it was not
+    reported before. The message is only created, if it is needed.
+
+    @return True, if reported, False if it was a duplicate
+    """
     global records
     global findings
 
-    for f in findings:
-        if f["message"] == message:
-            if (f["record1"] == record1 and f["record2"] == record2) or (f["record1"] == record2 and f["record2"] == record1):
-                if (f["p1"] == p1 and f["p2"] == p2) or (f["p1"] == p2 and f["p2"] == p1):
-                    return
-
-    f = {}
-    f["message"] = message
-    f["record1"] = record1
-    f["record2"] = record2
-    f["p1"] = p1
-    f["p2"] = p2
-    findings.append(f)
-
-    message = message + "\n"
-    n1 = f'{record1["name"]}:{record1["class"]}'
-    if "floor" in record1 and "ceiling" in record1:
-        h1 = f'({record1["floor"]}-{record1["ceiling"]})'
-    else:
-        h1 = ""
-    n2 = f'{record2["name"]}:{record2["class"]}'
-    if "floor" in record2 and "ceiling" in record2:
-        h2 = f'({record2["floor"]}-{record2["ceiling"]})'
-    else:
-        h2 = ""
+    key = findingKey(message, record1, record2, p1, p2)
+    if key in findings:
+        return False
+    findings.add(key)
 
     n1 = common.getAirspaceName2(record1)
     n2 = common.getAirspaceName2(record2)
-    h1 = ""
-    h2 = ""
-
-    l1 = max(len(n1), len(n2))
-    l2 = max(len(h1), len(h2))
-
-    ll1 = common.strLatLon(p1)
-    ll2 = common.strLatLon(p2)
     p1s = findLatLon(p1)
     p2s = findLatLon(p2)
-    c1 = len(p1s)
-    c2 = len(p2s)
-    p1ss = []
-    for element in p1s:
-        if "lineno" in element:
-            p1ss.append(element["lineno"])
-    p2ss = []
-    for element in p2s:
-        if "lineno" in element:
-            p2ss.append(element["lineno"])
-
-    message = message + \
-        f'  {n1:{l1}} {h1:{l2}}: {ll1} ({c1}x: lineno {p1ss})' + "\n"
-    message = message + \
-        f'  {n2:{l1}} {h2:{l2}}: {ll2} ({c2}x: lineno {p2ss})' + "\n"
-    common.problem(common.Prio.WARN, message)
+    p1ss = [lineno for (_, _, lineno) in p1s if lineno != None]
+    p2ss = [lineno for (_, _, lineno) in p2s if lineno != None]
 
+    def text():
+        h1 = ""
+        h2 = ""
 
-def findNearPoints(record_base, p1):
-    global records
-    global args
+        l1 = max(len(n1), len(n2))
+        l2 = max(len(h1), len(h2))
+
+        ll1 = common.strLatLon(p1)
+        ll2 = common.strLatLon(p2)
+        c1 = len(p1s)
+        c2 = len(p2s)
+
+        result = message + "\n"
+        result = result + \
+            f'  {n1:{l1}} {h1:{l2}}: {ll1} ({c1}x: lineno {p1ss})' + "\n"
+        result = result + \
+            f'  {n2:{l1}} {h2:{l2}}: {ll2} ({c2}x: lineno {p2ss})' + "\n"
+        return result
+
+    # The message contains line numbers, so the fingerprint is made of
+    # the names and points
+    def identity():
+        return [message] + sorted([[n1, common.strLatLon(p1)],
+                                   [n2, common.strLatLon(p2)]])
+
+    common.problem(common.Prio.WARN, text, key=key, lines=sorted(set(p1ss + p2ss)),
+                   names=[n1, n2], identity=identity)
+    return True
+
+
+def collectPoints(records):
+    """
+    Collect all points (DP) and the start and end points of all DB
+    arcs (but not DA) in the order of the file.
+
+    @return list of (record, location)
+    """
+
+    points = []
     for record in records:
         for element in record["elements"]:
             if element["type"] == "point":
-                (distance_m, bearing) = common.geo_distance(
-                    p1[0], p1[1], element["location"][0], element["location"][1])
-                distance_m = distance_m / 100        # convert cm to m
-                if distance_m > 0 and distance_m < args.distance:
-                    findingForTwoPoints(
-                        f'Airspaces with close points ({int(distance_m)}m):', record_base, record, p1, element["location"])
+                points.append((record, element["location"]))
             if element["type"] == "arc" and not "radius" in element:
                 # Only go for DB and not DA
-                (distance_m, bearing) = common.geo_distance(
-                    p1[0], p1[1], element["start"][0], element["start"][1])
-                distance_m = distance_m / 100        # convert cm to m
-                if distance_m > 0 and distance_m < args.distance:
-                    findingForTwoPoints(
-                        f'Airspaces with close points ({int(distance_m)}m):', record_base, record, p1, element["start"])
-                (distance_m, bearing) = common.geo_distance(
-                    p1[0], p1[1], element["end"][0], element["end"][1])
-                distance_m = distance_m / 100        # convert cm to m
-                if distance_m > 0 and distance_m < args.distance:
-                    findingForTwoPoints(
-                        f'Airspaces with close points ({int(distance_m)}m):', record_base, record, p1, element["end"])
-
-
-def checkPoints(records):
+                points.append((record, element["start"]))
+                points.append((record, element["end"]))
+    return points
+
+
+def reportClosePoints(record_base, p1, close, points):
+    """
+    Report the close points found by findClose().
+
+    @return number of suppressed duplicate findings
+    """
+
+    suppressed = 0
+    for (k, distance_m) in close:
+        (record, p2) = points[k]
+        if not findingForTwoPoints(
+                f'Airspaces with close points ({int(distance_m)}m):', record_base, record, p1, p2):
+            suppressed += 1
+    return suppressed
+
+
+def preparePoints(records):
+    """
+    Collect all points (see collectPoints()) and build the
+    common.PointGrid of their locations.
+
+    @return (points, locations, grid)
+    """
+
+    points = collectPoints(records)
+    locations = [p for (_, p) in points]
+    return (points, locations, common.PointGrid(locations, args.distance))
+
+
+def checkPoints(records, start=0, end=None, prepared=None):
     """
     Walk through all points and find other points which are close but not identical.
+    Only the points start to end (see collectPoints()) are compared with all others.
+
+    @param prepared result of preparePoints(records), if already built
+    @return number of suppressed duplicate findings
     """
 
-    for record in records:
-        # pprint(record)
-        # print("Checking", record["name"])
-        for element in record["elements"]:
-            if element["type"] == "point":
-                # pprint(element)
-                findNearPoints(record, element["location"])
-            if element["type"] == "arc":
-                # pprint(element)
-                if not "radius" in element:
-                    findNearPoints(record, element["start"])
-                    findNearPoints(record, element["end"])
+    (points, locations, grid) = prepared or preparePoints(records)
+    suppressed = 0
+    for (record, p1) in points[start:end]:
+        suppressed += reportClosePoints(record, p1,
+                                        findClose(p1, locations, grid), points)
+    return suppressed
+
+
+def findClusters(records):
+    """
+    Find all clusters of coordinates, that are closer than args.distance
+    but not identical (see common.clusterPoints()).
+
+    The canonical coordinate of a cluster is the one used most often
+    (the first one in the file, if several are used equally often), so
+    that snapping changes as few lines as possible.
+
+    @return list of (canonical coordinate, list of (coordinate,
+    distance to the canonical coordinate in m, uses)), where uses is a
+    list of (record, element, lineno)
+    """
+
+    coordinates = common.buildCoordinateIndex(records, centers=True)
+    locations = list(coordinates)
+    labels = common.clusterPoints(locations, args.distance)
+
+    members = {}
+    for (location, label) in zip(locations, labels.tolist()):
+        members.setdefault(label, []).append(location)
+
+    clusters = []
+    for cluster in members.values():
+        if len(cluster) > 1:
+            canonical = max(cluster,
+                            key=lambda location: len(coordinates[location]))
+            clusters.append((canonical, [
+                (location,
+                 common.geo_distance(canonical[0], canonical[1],
+                                     location[0], location[1])[0] / 100,
+                 coordinates[location])
+                for location in cluster]))
+    return clusters
+
+
+def isSnappable(cluster):
+    """
+    A cluster is only snapped, if all coordinates are closer than
+    args.distance to the canonical coordinate. Longer chains of close
+    points are usually finely resolved curves, which would collapse.
+    """
+    return all(distance_m < args.distance for (_, distance_m, _) in cluster)
+
+
+def checkClusters(records):
+    """
+    Report every cluster of close but not identical coordinates once,
+    together with the coordinate all members should be snapped to.
+    """
+
+    for (canonical, cluster) in findClusters(records):
+        max_distance_m = max(distance_m for (_, distance_m, _) in cluster)
+        message = f'{len(cluster)} close coordinates (up to {int(max_distance_m)}m apart), '
+        if isSnappable(cluster):
+            message += f'suggested: {common.strLatLon(canonical)}\n'
+        else:
+            message += f'too far apart to snap\n'
+        all_names = set()
+        all_linenos = set()
+        for (location, distance_m, uses) in cluster:
+            names = sorted(set(common.getAirspaceName2(record)
+                               for (record, _, _) in uses))
+            linenos = [lineno for (_, _, lineno) in uses if lineno != None]
+            message += (f'  {common.strLatLon(location)}({int(distance_m):4d}m, {len(uses)}x: '
+                        f'lineno {linenos}) {", ".join(names)}\n')
+            all_names.update(names)
+            all_linenos.update(linenos)
+        common.problem(common.Prio.WARN, message, lines=sorted(all_linenos),
+                       names=sorted(all_names),
+                       identity=[common.strLatLon(location) for (location, _, _) in cluster])
 
 
 def checkDB(records):
@@ -197,7 +352,8 @@ def checkDB(records):
                         if "lineno" in element:
                             lineno = element["lineno"]
                         common.problem(
-                            prio, f'DB has a big difference radius between start and end of {diff_m:.0f}m', lineno)
+                            prio, f'DB has a big difference radius between start and end of {diff_m:.0f}m', lineno,
+                            names=[common.getAirspaceName2(record)])
                         # The following will try to find a better center:
                         # unclear, if this helps is a good idea.
                         # common.improve_DB(element)
@@ -256,7 +412,8 @@ def checkOpenAirspaces(records):
             if "lineno" in firstElement:
                 line_start = firstElement["lineno"]
             common.problem(
-                common.Prio.WARN, f'airspace "{name},{dimension}" is not closed with a gap of {gap_km:.1f}km.', line_start)
+                common.Prio.WARN, f'airspace "{name},{dimension}" is not closed with a gap of {gap_km:.1f}km.', line_start,
+                names=[common.getAirspaceName2(record)])
 
 
 def checkNameEncoding(records):
@@ -271,7 +428,8 @@ def checkNameEncoding(records):
             if "lineno" in record:
                 lineno = record["lineno"]
             common.problem(
-                common.Prio.ERR, f'Airspace name contains non-ascii characters: "{name}"', lineno)
+                common.Prio.ERR, f'Airspace name contains non-ascii characters: "{name}"', lineno,
+                names=[common.getAirspaceName2(record)])
 
 
 def checkValidUTF8(filename):
@@ -309,35 +467,101 @@ def checkEncoding(fp):
             common.problem(common.Prio.WARN, message, lineno)
 
 
-def isSelfIntersecting(polygon):
+def orientation(p, q, r):
+    """
+    Vectorized orientation test of the points r relative to the lines p->q.
 
-    for i in range(0, len(polygon.exterior.coords)-1):
-        line1 = LineString([polygon.exterior.coords[i],
-                           polygon.exterior.coords[i+1]])
-        # print(line1)
-        for j in range(i+1, len(polygon.exterior.coords)-1):
-            line2 = LineString([polygon.exterior.coords[j],
-                               polygon.exterior.coords[j+1]])
-            if line1.crosses(line2):
-                message = f'Illegal line crossing:\n'
-                message += common.strLatLon(polygon.exterior.coords[i]) + " " + common.strLatLon(
-                    polygon.exterior.coords[i+1]) + "\n"
-                message += common.strLatLon(polygon.exterior.coords[j]) + " " + common.strLatLon(
-                    polygon.exterior.coords[j+1])
-                common.problem(common.Prio.WARN, message)
-                return True
+    @return tuple of the cross products and their maximum rounding error
+    """
+    (dx1, dy1) = ((q - p)[:, 0], (q - p)[:, 1])
+    (dx2, dy2) = ((r - p)[:, 0], (r - p)[:, 1])
+    error = 1e-12 * (np.abs(dx1 * dy2) + np.abs(dy1 * dx2))
+    return (dx1 * dy2 - dy1 * dx2, error)
 
-    return False
 
+def isOnSameSide(p, q, r1, r2):
+    """
+    @return boolean array, whether r1 and r2 are for sure on the same
+    side of the lines p->q.
+    """
+    (o1, e1) = orientation(p, q, r1)
+    (o2, e2) = orientation(p, q, r2)
+    return ((o1 > e1) & (o2 > e2)) | ((o1 < -e1) & (o2 < -e2))
 
-def checkInvalidPolygons(records):
+
+def findCrossingCandidates(coords):
     """
-    Walk through all records and check if the polygon is valid.
+    Find all pairs of segments of the given ring, that may cross.
+
+    The segments are put into a STRtree to find all pairs with
+    intersecting bounding boxes. Pairs sharing an end point can not
+    cross. From the remaining pairs only those are kept, where no
+    orientation test proves that they are apart.
+
+    @param coords array of shape (N, 2) of the closed ring
+    @return arrays i, j of the segment indices, sorted by i and then j
+    """
+    a = coords[:-1]
+    b = coords[1:]
+    segments = shapely.linestrings(np.stack((a, b), axis=1))
+    tree = shapely.STRtree(segments)
+    (i, j) = tree.query(segments)
+    mask = i < j
+    (i, j) = (i[mask], j[mask])
+
+    shared = ((a[i] == a[j]).all(axis=1) | (a[i] == b[j]).all(axis=1) |
+              (b[i] == a[j]).all(axis=1) | (b[i] == b[j]).all(axis=1))
+    apart = (isOnSameSide(a[i], b[i], a[j], b[j]) |
+             isOnSameSide(a[j], b[j], a[i], b[i]))
+    mask = ~shared & ~apart
+    (i, j) = (i[mask], j[mask])
+
+    order = np.lexsort((j, i))
+    return (i[order], j[order])
+
+
+def isSelfIntersecting(polygon):
+    """
+    Check, whether two segments of the exterior of the polygon cross
+    each other. The first crossing (ordered by the segments) is reported.
+    """
+
+    if polygon.exterior.is_simple:
+        return False
+
+    common.profileCount("slow path polygons")
+    coords = np.array(polygon.exterior.coords)
+    (i, j) = findCrossingCandidates(coords)
+    common.profileCount("crossing candidates", len(i))
+    if len(i) == 0:
+        return False
+
+    lines1 = shapely.linestrings(np.stack((coords[i], coords[i+1]), axis=1))
+    lines2 = shapely.linestrings(np.stack((coords[j], coords[j+1]), axis=1))
+    crosses = np.flatnonzero(shapely.crosses(lines1, lines2))
+    if len(crosses) == 0:
+        return False
+
+    (i, j) = (int(i[crosses[0]]), int(j[crosses[0]]))
+    coords = polygon.exterior.coords
+    message = f'Illegal line crossing:\n'
+    message += common.strLatLon(coords[i]) + " " + common.strLatLon(
+        coords[i+1]) + "\n"
+    message += common.strLatLon(coords[j]) + " " + common.strLatLon(
+        coords[j+1])
+    common.problem(common.Prio.WARN, message)
+    return True
+
+
+def checkInvalidPolygons(records, start=0, end=None):
+    """
+    Walk through the records[start:end] and check if the polygon is valid.
     It is considered invalid, if https://shapely.readthedocs.io/en/stable/reference/shapely.Polygon.html#shapely.Polygon.is_valid is not true.
     """
     global args
 
-    for record in records:
+    for record in records[start:end]:
+        common.profileCount("polygons")
         # print("checkInvalidPolygon(",common.getAirspaceName2(record))
         # "is_valid" is a very fast check, that sometimes gives false positives
         if args.complete_check or not record["polygon"].is_valid:
@@ -345,83 +569,454 @@ def checkInvalidPolygons(records):
             # In that case do the slow check, to give only real problems:
             if isSelfIntersecting(record["polygon"]):
                 common.problem(common.Prio.ERR, "Invalid (selfintersect) Polygon for " +
-                               common.getAirspaceName2(record) + ": " + explain_validity(record["polygon"]))
+                               common.getAirspaceName2(record) + ": " +
+                               explain_validity(record["polygon"]),
+                               names=[common.getAirspaceName2(record)])
 
 
-def iH(record1, record2):
-    if record1["ceiling_ft"] > record2["floor_ft"] and record1["ceiling_ft"] < record2["ceiling_ft"]:
-        return True
-    if record1["floor_ft"] >= record2["floor_ft"] and record1["floor_ft"] < record2["ceiling_ft"]:
-        return True
-    if record1["floor_ft"] >= record2["floor_ft"] and record1["ceiling_ft"] < record2["ceiling_ft"]:
-        return True
-    return False
+def checkContentEncoding(records):
+    content.seek(0, io.SEEK_SET)
+    checkEncoding(content)
 
 
-def intersectsInHeight(record1, record2):
-    return iH(record1, record2) or iH(record2, record1)
+def reportOverlappingAirspaces(overlap):
+    for record1, record2 in overlap:
+        common.problem(common.Prio.ERR, "Overlapping Airspaces " +
+                       common.getAirspaceName2(record1) + ", " +
+                       common.getAirspaceName2(record2),
+                       names=[common.getAirspaceName2(record1), common.getAirspaceName2(record2)])
 
 
-def getOverlappingAirspaces(records):
-    overlap = []
-    num_records = len(records)
-    for i in range(0, num_records):
-        record1 = records[i]
-        for j in range(i+1, num_records):
-            record2 = records[j]
-            if intersectsInHeight(record1, record2):
-                if record1["polygon"].intersects(record2["polygon"]):
-                    # print("Check Overlapping Airspaces " + common.getAirspaceName2(record1) + ", " + common.getAirspaceName2(record2))
-                    intersection = shapely.intersection(
-                        record1["polygon"], record2["polygon"])
-                    area = intersection.area
-                    if area > 0:
-                        overlap.append([record1, record2])
+def checkOverlappingAirspaces(records):
+    reportOverlappingAirspaces(common.getOverlappingAirspaces(records))
 
-    return overlap
 
+def closeOpenAirspaces(lines, records):
+    """
+    Close all open airspaces, where the first and the last point of the
+    polygon are not the same, by inserting the first point after the
+    last element.
 
-def checkOverlappingAirspaces(records):
-    overlap = common.getOverlappingAirspaces(records)
-    for record1, record2 in overlap:
-        common.problem(common.Prio.ERR, "Overlapping Airspaces " +
-                       common.getAirspaceName2(record1) + ", " + common.getAirspaceName2(record2))
+    The closing points are looked up by the line number of the last
+    element of each open airspace.
 
+    @param lines iterable of the lines of the file
+    @return generator of the fixed lines
+    """
+
+    closing = {}
+    for record in findOpenAirspaces(records):
+        lastElement = record["elements"][-1]
+        if "lineno" in lastElement:
+            firstPoint = getFirstPoint(record["elements"][0])
+            firstPoint_latlon = common.strLatLon(firstPoint)
+            closing.setdefault(lastElement["lineno"], []).append(
+                f'DP {firstPoint_latlon}\n')
+
+    for (lineno, line) in enumerate(lines, start=1):
+        yield line
+        if lineno in closing:
+            yield from closing[lineno]
+
+
+def snapCoordinates(lines, records):
+    """
+    Replace all coordinates of a snappable cluster (see findClusters()
+    and isSnappable()) in DP, DB and V X= lines by the canonical
+    coordinate of the cluster. All other text of the lines is kept.
 
-def fixOpenAirspaces(fp, records):
+    @param lines iterable of the lines of the file
+    @return generator of the fixed lines
     """
-    Read in from the given file and write out a new file
-    with all open airspaces closed. This fixes airspaces,
-    where the first and the last point of the polygon are not the same.
 
-    The filename of the new file is derived from args.filename by
+    snap = {}
+    for (canonical, cluster) in findClusters(records):
+        if isSnappable(cluster):
+            for (location, _, _) in cluster:
+                if location != canonical:
+                    snap[location] = common.strLatLon(canonical).strip()
+
+    def replace(match):
+        location = common.parseCoordinate(match.group(0))
+        if location not in snap:
+            return match.group(0)
+        prefix = match.group(0)[:match.start(1) - match.start(0)]
+        suffix = match.group(0)[match.end(8) - match.start(0):]
+        return prefix + snap[location] + suffix
+
+    for line in lines:
+        statement = line.lstrip()
+        if statement.startswith(("DP", "DB")) or re.match(r'V\s*X\s*=', statement):
+            pos = line.find('*')
+            if pos < 0:
+                line = common.COORDINATE_FORMAT.sub(replace, line)
+            else:
+                line = (common.COORDINATE_FORMAT.sub(replace, line[:pos]) +
+                        line[pos:])
+        yield line
+
+
+def writeFixed(lines):
+    """
+    Write the fixed lines into args.fix_output ("-" for stdout). If it
+    is not given, the filename is derived from args.filename by
     inserting the current date into the filename.
     """
 
-    (root, ext) = os.path.splitext(args.filename)
-    now_iso = datetime.now().isoformat(timespec='seconds')
-    filename_fixed = f'{root}-{now_iso}{ext}'
+    if args.fix_output == "-":
+        print(f'Fixing into stdout', file=sys.stderr)
+        # Write the same bytes as into a file
+        sys.stdout.flush()
+        fp = io.TextIOWrapper(sys.stdout.buffer, encoding='latin-1',
+                              newline='')
+        fp.writelines(lines)
+        fp.flush()
+        fp.detach()
+        return
+
+    if args.fix_output != None:
+        filename_fixed = args.fix_output
+    else:
+        (root, ext) = os.path.splitext(args.filename)
+        now_iso = datetime.now().isoformat(timespec='seconds')
+        filename_fixed = f'{root}-{now_iso}{ext}'
     print(f'Fixing into {filename_fixed}')
 
-    records = findOpenAirspaces(records)
+    with open(filename_fixed, "w", encoding='latin-1', newline='') as fp_f:
+        fp_f.writelines(lines)
 
-    lineno = 0
-    with open(filename_fixed, "w", newline='') as fp_f:
-        for line in fp:
-            fp_f.write(line)
-            lineno = lineno + 1
-            for record in records:
-                lastElement = record["elements"][-1]
-                if "lineno" in lastElement:
-                    if lastElement["lineno"] == lineno:
-                        firstElement = record["elements"][0]
-                        firstPoint = getFirstPoint(firstElement)
-                        firstPoint_latlon = common.strLatLon(firstPoint)
-                        fp_f.write(f'DP {firstPoint_latlon}\n')
+
+class Check:
+    """
+    A check registered in CHECKS.
+
+    function(records) reports all problems by common.problem() and
+    returns the number of suppressed duplicate findings (or None).
+
+    If size is given, the check is partitioned: size(records) is the
+    number of items (e.g. records or points) checked and
+    function(records, start, end) checks only the items start to end,
+    so that the partitions can be checked in parallel.
+
+    If prepare is given, prepare(records) builds the data shared by
+    all partitions once before they are run (and before the workers
+    are forked). size(prepared) then returns the number of items and
+    the partitions are checked by function(records, start, end,
+    prepared).
+
+    If enabled is given, the check is only run if enabled() is True.
+
+    With --incremental, a check with per_record set is only run on the
+    changed records (see IncrementalState) and a check with incremental
+    set is run as incremental(records, state) instead of function().
+    """
+
+    def __init__(self, name, function, size=None, enabled=None,
+                 per_record=False, incremental=None, prepare=None):
+        self.name = name
+        self.function = function
+        self.size = size
+        self.prepare = prepare
+        self.enabled = enabled
+        self.per_record = per_record
+        self.incremental = incremental
+
+
+#
+# Incremental checking (--incremental).
+#
+# The findings of the checks of single records and the pairs found by
+# the checks of pairs of records are stored with the keys of the
+# records (see common.recordKeys()) in
+#
+# <cache_dir>/incremental/checks-<hash of the options>.json
+#
+# Only the changed records are checked again and only the pairs with a
+# changed record are searched again. All findings are then reported in
+# the same order as without --incremental.
+#
+
+CHECK_CACHE_VERSION = 2
+
+
+class IncrementalState:
+    """
+    The results of the last run and of this run by the keys of the
+    records.
+    """
+
+    def __init__(self, records):
+        global args
+
+        self.keys = common.recordKeys(records)
+        options = json.dumps([CHECK_CACHE_VERSION, common.arcOptions(),
+                              args.distance, args.complete_check])
+        self.filename = os.path.join(
+            args.cache_dir, "incremental",
+            f'checks-{hashlib.sha256(options.encode()).hexdigest()[:16]}.json')
+
+        try:
+            with open(self.filename) as fp:
+                self.previous = json.load(fp)
+        except (OSError, ValueError):
+            self.previous = {"keys": [], "findings": {}, "pairs": {}}
+
+        previous_keys = set(self.previous["keys"])
+        self.changed = [key not in previous_keys for key in self.keys]
+        self.index = {id(record): i for (i, record) in enumerate(records)}
+        self.findings = {key: {} for key in self.keys}
+        self.pairs = {}
+
+    def changedFor(self, name):
+        """
+        @return list, whether each record has to be checked again by the
+        check of pairs with the given name. All records have to be
+        checked, if the check did not run last time.
+        """
+        if name in self.previous["pairs"]:
+            return self.changed
+        return [True] * len(self.keys)
+
+    def previousPairs(self, name):
+        """
+        @return list of (i, k1, j, k2, value) of all pairs of the last
+        run between unchanged records, with the records as indices into
+        records of this run
+        """
+        if not name in self.previous["pairs"]:
+            return []
+        current = {key: i for (i, key) in enumerate(self.keys)}
+        previous = [current.get(key) for key in self.previous["keys"]]
+        pairs = []
+        for (i, k1, j, k2, value) in self.previous["pairs"].get(name, []):
+            (i, j) = (previous[i], previous[j])
+            if i != None and j != None:
+                pairs.append((i, k1, j, k2, value))
+        return pairs
+
+    def store(self):
+        content = json.dumps({"keys": self.keys, "findings": self.findings,
+                              "pairs": self.pairs})
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        common.writeFileAtomic(self.filename, content)
+
+
+def checkRecordsIncremental(check, records, state):
+    """
+    Run the check on every changed record and take the findings of the
+    unchanged ones from the last run. The line numbers are stored
+    relative to the first line of the record.
+    """
+
+    for (i, record) in enumerate(records):
+        key = state.keys[i]
+        base = common.getAirspaceLine(record) or 0
+        if state.changed[i]:
+            with common.collectProblems() as found:
+                check.function([record])
+            found = [[finding.prio.name, finding.message,
+                      None if finding.lineno == None else finding.lineno - base,
+                      [lineno - base for lineno in finding.lines or []],
+                      finding.names, finding.identity]
+                     for finding in found]
+        else:
+            found = state.previous["findings"][key].get(check.name, [])
+        state.findings[key][check.name] = found
+        for (prio, message, lineno, lines, names, identity) in found:
+            common.problem(common.Prio[prio], message,
+                           None if lineno == None else lineno + base,
+                           lines=[lineno + base for lineno in lines] or None,
+                           names=names, identity=identity)
+
+
+def findCloseIncremental(name, items, records, state):
+    """
+    Find the close locations of all items (see findClose()). Only the
+    items of changed records are searched, the other pairs are taken
+    from the last run.
+
+    @param items list of (record, location)
+    @return list of the close items of every item
+    """
+
+    locations = [p for (_, p) in items]
+    grid = common.PointGrid(locations, args.distance)
+
+    # Identify every item by its record and its number in the record
+    ids = []
+    count = {}
+    for (record, _) in items:
+        i = state.index[id(record)]
+        count[i] = count.get(i, 0) + 1
+        ids.append((i, count[i] - 1))
+    position = {item_id: k for (k, item_id) in enumerate(ids)}
+
+    changed = state.changedFor(name)
+    close = [[] for _ in items]
+    for (k, (i, _)) in enumerate(ids):
+        if changed[i]:
+            close[k] = findClose(locations[k], locations, grid)
+            for (l, distance_m) in close[k]:
+                if not changed[ids[l][0]]:
+                    close[l].append((k, distance_m))
+    for (i, k1, j, k2, distance_m) in state.previousPairs(name):
+        if (i, k1) in position and (j, k2) in position:
+            close[position[(i, k1)]].append((position[(j, k2)], distance_m))
+    for found in close:
+        found.sort()
+
+    state.pairs[name] = [[*ids[k], *ids[l], distance_m]
+                         for (k, found) in enumerate(close)
+                         for (l, distance_m) in found]
+    return close
+
+
+def checkCirclesIncremental(records, state):
+    circles = collectCircles(records)
+    close = findCloseIncremental("checkCircles", circles, records, state)
+    suppressed = 0
+    for ((record, center), found) in zip(circles, close):
+        suppressed += reportNearCircles(record, center, found, circles)
+    return suppressed
+
+
+def checkPointsIncremental(records, state):
+    points = collectPoints(records)
+    close = findCloseIncremental("checkPoints", points, records, state)
+    suppressed = 0
+    for ((record, p1), found) in zip(points, close):
+        suppressed += reportClosePoints(record, p1, found, points)
+    return suppressed
+
+
+def checkOverlappingIncremental(records, state):
+    changed = state.changedFor("checkOverlappingAirspaces")
+    pairs = [(i, j, error) for (i, _, j, _, error) in
+             state.previousPairs("checkOverlappingAirspaces")]
+    subset = [i for (i, c) in enumerate(changed) if c]
+    failed = []
+    for (record1, record2) in common.getOverlappingAirspaces(records, subset, failed):
+        pairs.append((state.index[id(record1)], state.index[id(record2)],
+                      None))
+    for (record1, record2, error) in failed:
+        pairs.append((state.index[id(record1)], state.index[id(record2)],
+                      error))
+    pairs.sort(key=lambda pair: pair[:2])
+
+    state.pairs["checkOverlappingAirspaces"] = [[i, 0, j, 0, error]
+                                                for (i, j, error) in pairs]
+    # The failed intersections are reported first, as they are found
+    # while searching the overlapping airspaces
+    for (i, j, error) in pairs:
+        if error != None:
+            common.reportInvalidOverlap(records[i], records[j], error)
+    reportOverlappingAirspaces([(records[i], records[j])
+                                for (i, j, error) in pairs if error == None])
+
+
+# All checks in the order of their output
+CHECKS = [
+    Check("checkInvalidPolygons", checkInvalidPolygons, size=len,
+          per_record=True),
+    Check("checkOverlappingAirspaces", checkOverlappingAirspaces,
+          enabled=lambda: args.check_overlap,
+          incremental=checkOverlappingIncremental),
+    Check("checkDB", checkDB, per_record=True),
+    Check("checkEncoding", checkContentEncoding),
+    Check("checkOpenAirspaces", checkOpenAirspaces, per_record=True),
+    Check("checkNameEncoding", checkNameEncoding, per_record=True),
+    Check("checkCircles", checkCircles,
+          prepare=prepareCircles,
+          size=lambda prepared: len(prepared[0]),
+          enabled=lambda: not args.clusters,
+          incremental=checkCirclesIncremental),
+    Check("checkPoints", checkPoints,
+          prepare=preparePoints,
+          size=lambda prepared: len(prepared[0]),
+          enabled=lambda: not args.clusters,
+          incremental=checkPointsIncremental),
+    Check("checkClusters", checkClusters,
+          enabled=lambda: args.clusters),
+]
+
+
+def runCheck(k, start, end):
+    """
+    Run CHECKS[k] (on the items start to end, if it is partitioned).
+
+    @return (list of common.Finding, number of suppressed duplicate findings)
+    """
+    check = CHECKS[k]
+    with common.profilePhase(check.name), common.checking(check.name), \
+            common.collectProblems() as found:
+        if incremental != None and check.per_record:
+            suppressed = checkRecordsIncremental(check, records, incremental)
+        elif incremental != None and check.incremental != None:
+            suppressed = check.incremental(records, incremental)
+        elif check.size == None:
+            suppressed = check.function(records)
+        elif check.prepare != None:
+            suppressed = check.function(records, start, end, prepared[k])
+        else:
+            suppressed = check.function(records, start, end)
+        common.profileCount("findings", len(found))
+    for finding in found:
+        finding.prepare()
+    return (found, suppressed or 0)
+
+
+def runChecks(records):
+    """
+    Run all enabled checks. With args.jobs > 1 the checks and the
+    partitions of the partitioned checks are run in a process pool. The
+    workers get all data by fork(), also the data of the partitioned
+    checks prepared before.
+
+    The findings are reported in the order of CHECKS and of the
+    partitions, so the output does not depend on the number of jobs.
+    Duplicate findings of different partitions are suppressed like
+    the ones within a partition.
+    """
+
+    tasks = []
+    for (k, check) in enumerate(CHECKS):
+        if check.enabled != None and not check.enabled():
+            continue
+        if check.size == None or incremental != None:
+            tasks.append((k, None, None))
+            continue
+        if check.prepare != None:
+            with common.profilePhase(check.name):
+                prepared[k] = check.prepare(records)
+            size = check.size(prepared[k])
+        else:
+            size = check.size(records)
+        step = max(1, math.ceil(size / (args.jobs * 4)))
+        for start in range(0, size, step):
+            tasks.append((k, start, min(start + step, size)))
+
+    if args.jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.jobs,
+                mp_context=multiprocessing.get_context("fork")) as executor:
+            results = list(executor.map(runCheck, *zip(*tasks)))
+    else:
+        results = [runCheck(*task) for task in tasks]
+
+    with common.profilePhase("report"):
+        for (k, group) in itertools.groupby(zip(tasks, results), key=lambda result: result[0][0]):
+            seen = set()
+            suppressed = 0
+            for (task, (found, n)) in group:
+                suppressed += n + common.reportFindings(found, seen)
+            printSuppressed(CHECKS[k].name, suppressed)
 
 
 records = []
-findings = []
+prepared = {}
+findings = set()
+coordinates = {}
+incremental = None
 
 parser = argparse.ArgumentParser(
     description='Check OpenAir airspace file for consistency')
@@ -439,60 +1034,120 @@ parser.add_argument("-p", "--point",
                     help="Find all other points near this point.")
 parser.add_argument("-F", "--fix-closing", action="store_true",
                     help="Fix all open airspaces by inserting a closing point")
+parser.add_argument("-C", "--clusters", action="store_true",
+                    help="Report clusters of close coordinates once instead of every pair of close points and circles")
+parser.add_argument("-S", "--snap", action="store_true",
+                    help="Snap all coordinates of a cluster to its suggested coordinate")
+parser.add_argument("--fix-output",
+                    help="Write the result of --fix-closing or --snap into this file (\"-\" for stdout)")
+parser.add_argument("--format", choices=["text", "jsonl", "sarif"], default="text",
+                    help="Print the findings as text, JSON Lines or SARIF (default text)")
+parser.add_argument("-b", "--baseline", metavar="FILE",
+                    help="Do not report the known problems, whose fingerprints are in FILE (see --write-baseline)")
+parser.add_argument("--write-baseline", metavar="FILE",
+                    help="Write the fingerprints of all problems found into FILE")
 parser.add_argument("-n", "--no-arc", action="store_true",
                     help="Resolve arcs as straight line")
 parser.add_argument("-f", "--fast-arc", action="store_true",
                     help="Resolve arcs with less quality (10 degree steps)")
+parser.add_argument("--arc-tolerance", type=float, metavar="METERS",
+                    help="Resolve arcs with steps, that deviate at most METERS from the arc, instead of fixed steps")
 parser.add_argument("-c", "--complete-check", action="store_true",
                     help="Check all airspaces EXACTLY for geometry errors")
+parser.add_argument("--cache-dir",
+                    help="Cache parsed and resolved airspaces in this directory")
+parser.add_argument("-I", "--incremental", action="store_true",
+                    help="With --cache-dir, only check the airspaces changed since the last run again. All checks run in one process.")
+parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                    help="Number of processes running the checks")
+parser.add_argument("--profile", metavar="FILE",
+                    help="Measure time, memory and counts of all phases, print them as table and write them as JSON into FILE. All checks run in one process.")
+parser.add_argument("--cprofile", metavar="PHASE",
+                    help="With --profile, also run PHASE (e.g. checkPoints) under cProfile and dump the statistics into FILE-PHASE.prof")
+parser.add_argument("--profile-no-memory", action="store_true",
+                    help="With --profile, do not measure the peak memory (tracemalloc slows down some phases)")
 parser.add_argument("filename")
 args = parser.parse_args()
 common.setArgs(args)
 
-checkValidUTF8(args.filename)
+if args.incremental:
+    if args.cache_dir == None:
+        parser.error("--incremental requires --cache-dir")
+    args.jobs = 1
 
-# read file into a StringIO, as we have to parse it multiple times
-content = io.StringIO()
-with open(args.filename, encoding='latin-1', newline='') as fp:
-    content.write(fp.read())
+if args.profile:
+    common.profiler = common.Profiler(args.cprofile,
+                                      memory=not args.profile_no_memory)
+    args.jobs = 1
 
-content.seek(0, io.SEEK_SET)
-reader = aerofiles.openair.Reader(content)
+with common.profilePhase("read"):
+    checkValidUTF8(args.filename)
+
+    # read file into a StringIO, as we have to parse it multiple times
+    content = io.StringIO()
+    with open(args.filename, encoding='latin-1', newline='') as fp:
+        content.write(fp.read())
 
-for record, error in reader:
-    if error:
-        raise error
-    records.append(record)
-    # pprint(record)
+records = common.loadAirspace(
+    args.filename, resolve=args.point == None and not args.fix_closing and not args.snap)
+
+if args.arc_tolerance != None and args.point == None and not args.fix_closing and not args.snap:
+    points = sum(len(record["elements_resolved"]) for record in records)
+    print(f'Arcs resolved with at most {args.arc_tolerance:g}m deviation: {points} points '
+          f'instead of {common.countFixedStepPoints(records)} with fixed steps',
+          file=common.infoFile())
+
+with common.profilePhase("buildCoordinateIndex"):
+    coordinates = common.buildCoordinateIndex(records)
 
 if args.point != None:
     args.pointLatLon = aerofiles.openair.reader.coordinate(args.point)
     record = {}
     record["name"] = "POINT " + common.strLatLon(args.pointLatLon)
     record["class"] = ""
-    findNearPoints(record, args.pointLatLon)
+    identical = findLatLon(args.pointLatLon)
+    print(f'{record["name"]}is used {len(identical)}x:')
+    for (record_identical, element, lineno) in identical:
+        print(f'  {common.getAirspaceName2(record_identical)}: lineno {lineno}')
+    (points, locations, grid) = preparePoints(records)
+    reportClosePoints(record, args.pointLatLon,
+                      findClose(args.pointLatLon, locations, grid), points)
     sys.exit(0)
 
 content.seek(0, io.SEEK_SET)
 
-if args.fix_closing:
-    fixOpenAirspaces(content, records)
+if args.fix_closing or args.snap:
+    lines = content
+    if args.fix_closing:
+        lines = closeOpenAirspaces(lines, records)
+    if args.snap:
+        lines = snapCoordinates(lines, records)
+    writeFixed(lines)
     sys.exit(0)
 
-common.resolveRecordArcs(records)
-common.createPolygons(records)
-common.checkHeights(records)
+with common.profilePhase("checkHeights"), common.checking("checkHeights"):
+    common.checkHeights(records)
+
+if args.incremental:
+    with common.profilePhase("incremental"):
+        incremental = IncrementalState(records)
+        common.profileCount("changed records", sum(incremental.changed))
 
-checkInvalidPolygons(records)
-if args.check_overlap:
-    checkOverlappingAirspaces(records)
-checkDB(records)
-checkEncoding(content)
-checkOpenAirspaces(records)
-checkNameEncoding(records)
-checkCircles(records)
-checkPoints(records)
+runChecks(records)
 
+if incremental != None:
+    with common.profilePhase("incremental"):
+        incremental.store()
+
+common.finishReport()
 ret = common.printProblemCounts()
 
+if args.profile:
+    common.profiler.printTable()
+    common.profiler.writeJSON(args.profile, openair_file=args.filename,
+                              argv=sys.argv[1:], jobs=args.jobs)
+    if args.cprofile:
+        common.profiler.dumpCProfile(
+            f'{os.path.splitext(args.profile)[0]}-{args.cprofile}.prof')
+
 sys.exit(ret)
@@ -0,0 +1,59 @@
+#!/usr/bin/python # -*- mode: python; python-indent-offset: 4 -*-
+#
+# Compare the native OpenAir parser of common.py with the parser of
+# aerofiles. Both must return exactly the same records and errors
+# (including line numbers) for the given files.
+#
+
+import argparse
+import sys
+import time
+
+import aerofiles.openair
+
+import common
+
+
+def readAll(reader_class, filename):
+    result = []
+    with open(filename, encoding='latin-1', newline='') as fp:
+        for record, error in reader_class(fp):
+            if error:
+                error = (type(error).__name__, str(error),
+                         getattr(error, "lineno", None))
+            result.append((record, error))
+    return result
+
+
+def compare(filename):
+    start = time.perf_counter()
+    expected = readAll(aerofiles.openair.Reader, filename)
+    middle = time.perf_counter()
+    actual = readAll(common.OpenAirReader, filename)
+    end = time.perf_counter()
+
+    print(f'{filename}: {len(expected)} records, aerofiles {middle-start:.3f}s, native {end-middle:.3f}s')
+
+    if len(expected) != len(actual):
+        print(
+            f'ERR: aerofiles returned {len(expected)} records, native parser {len(actual)}')
+        return False
+    for (e, a) in zip(expected, actual):
+        if e != a:
+            print(f'ERR: records differ:\n  aerofiles: {e}\n  native:    {a}')
+            return False
+    return True
+
+
+parser = argparse.ArgumentParser(
+    description='Compare the native OpenAir parser with aerofiles')
+parser.add_argument("filename", nargs="+",
+                    help="One or more openair filenames")
+args = parser.parse_args()
+
+ok = True
+for filename in args.filename:
+    if not compare(filename):
+        ok = False
+
+sys.exit(0 if ok else 1)
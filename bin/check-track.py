@@ -0,0 +1,275 @@
+#!/usr/bin/python # -*- mode: python; python-indent-offset: 4 -*-
+#
+# Check flight tracks (IGC files) against an airspace file and print
+# all intervals, in which the track was inside an airspace (inside its
+# polygon and between its floor and ceiling).
+#
+# All fixes of a track are read into arrays and checked with a single
+# bulk query against the STRtree of common.AirspaceIndex. Several
+# tracks are checked in parallel by a process pool.
+#
+# As there is no terrain model, all heights are compared as if they
+# were MSL, even if the airspace is defined as AGL/GND.
+#
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import common
+
+# Length of the mandatory part of an IGC B record:
+# B HHMMSS DDMMmmmN DDDMMmmmE V PPPPP GGGGG
+B_RECORD_LEN = 35
+
+FEET_PER_METER = 3.28084
+
+
+def readFixes(filename):
+    """
+    Read all fixes (B records) of an IGC file into arrays.
+
+    The file is streamed line by line, only the fixed width part of the
+    B records is kept and then decoded in one array operation.
+
+    @return dict with arrays "time" (seconds since start of day,
+    continued after midnight), "lat", "lon", "pressure_alt" and
+    "gnss_alt" (in meters)
+    """
+
+    rows = []
+    with open(filename, "rb") as fp:
+        for line in fp:
+            if line.startswith(b"B") and len(line) >= B_RECORD_LEN:
+                rows.append(line[:B_RECORD_LEN])
+
+    chars = np.frombuffer(b"".join(rows), dtype=np.uint8)
+    chars = chars.reshape(-1, B_RECORD_LEN)
+    negative = chars == ord("-")
+    digits = np.where(negative, 0, chars.astype(np.int64) - ord("0"))
+
+    def number(start, end):
+        value = np.zeros(len(digits), dtype=np.int64)
+        for column in range(start, end):
+            value = value * 10 + digits[:, column]
+        return np.where(negative[:, start:end].any(axis=1), -value, value)
+
+    seconds = number(1, 3) * 3600 + number(3, 5) * 60 + number(5, 7)
+    # Continue the time after midnight
+    midnight = np.diff(seconds, prepend=seconds[:1]) < 0
+    seconds = seconds + 86400 * np.cumsum(midnight)
+
+    lat = number(7, 9) + number(9, 14) / 60000
+    lat = np.where(chars[:, 14] == ord("S"), -lat, lat)
+    lon = number(15, 18) + number(18, 23) / 60000
+    lon = np.where(chars[:, 23] == ord("W"), -lon, lon)
+
+    return {
+        "time": seconds,
+        "lat": lat,
+        "lon": lon,
+        "pressure_alt": number(25, 30),
+        "gnss_alt": number(30, 35),
+    }
+
+
+def findInfringements(index, fixes, altitude):
+    """
+    Find all intervals, in which the fixes are inside an airspace.
+
+    @param index common.AirspaceIndex of all airspaces
+    @param fixes as returned by readFixes()
+    @param altitude "gnss_alt" or "pressure_alt"
+
+    @return list of (record index, first fix, last fix), sorted by
+    first fix
+    """
+
+    coords = np.column_stack((fixes["lat"], fixes["lon"]))
+    (points, records) = index.find_many(coords)
+
+    altitude_ft = fixes[altitude][points] * FEET_PER_METER
+    inside = ((altitude_ft >= index.floor_ft[records]) &
+              (altitude_ft < index.ceiling_ft[records]))
+    points = points[inside]
+    records = records[inside]
+    if len(points) == 0:
+        return []
+
+    # Consecutive fixes in the same airspace form one interval
+    order = np.lexsort((points, records))
+    points = points[order]
+    records = records[order]
+    start = np.ones(len(points), dtype=bool)
+    start[1:] = (records[1:] != records[:-1]) | (points[1:] != points[:-1] + 1)
+    first = np.flatnonzero(start)
+    last = np.append(first[1:], len(points)) - 1
+
+    intervals = list(zip(records[first].tolist(), points[first].tolist(),
+                         points[last].tolist()))
+    intervals.sort(key=lambda interval: (interval[1], interval[0]))
+    return intervals
+
+
+def strTime(seconds):
+    seconds = seconds % 86400
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+index = None
+
+
+def initWorker(records):
+    """
+    Create the index of all airspaces once per worker process.
+    """
+    global index
+
+    index = common.AirspaceIndex(records)
+
+
+def checkTrack(filename, altitude):
+    """
+    Check one IGC file.
+
+    @return (filename, number of fixes, list of infringements as
+    (record index, start time, end time, max altitude in ft))
+    """
+
+    fixes = readFixes(filename)
+    result = []
+    for (record, first, last) in findInfringements(index, fixes, altitude):
+        alt_ft = fixes[altitude][first:last+1].max() * FEET_PER_METER
+        result.append((record, int(fixes["time"][first]),
+                       int(fixes["time"][last]), float(alt_ft)))
+    return (filename, len(fixes["time"]), result)
+
+
+def airspaceRecords(records):
+    """
+    Reduce the records to what is needed for the check, so that they
+    can be sent to the worker processes cheaply.
+    """
+    keys = ["name", "class", "floor", "ceiling",
+            "floor_ft", "ceiling_ft", "polygon"]
+    return [{k: record[k] for k in keys if k in record}
+            for record in records if "polygon" in record]
+
+
+def writeSyntheticTrack(filename, count, seed=0):
+    """
+    Write an IGC file with count fixes of a random flight over Germany.
+    """
+    rng = np.random.default_rng(seed)
+
+    def walk(start, step, low, high):
+        # Random walk, reflected at low and high
+        value = start - low + np.cumsum(rng.normal(0, step, count))
+        value = value % (2 * (high - low))
+        return low + np.minimum(value, 2 * (high - low) - value)
+
+    lat = walk(51.0, 0.002, 47.5, 55.0)
+    lon = walk(10.0, 0.003, 6.0, 15.0)
+    alt = walk(1000, 10, 0, 4000)
+    seconds = np.arange(count) % 86400
+
+    with open(filename, "w") as fp:
+        fp.write("AXXXSYNTHETIC\r\nHFDTE010126\r\n")
+        for (t, la, lo, al) in zip(seconds.tolist(), lat.tolist(), lon.tolist(), alt.tolist()):
+            la_min = round(la * 60000)
+            lo_min = round(lo * 60000)
+            fp.write(f'B{t // 3600:02d}{t // 60 % 60:02d}{t % 60:02d}'
+                     f'{la_min // 60000:02d}{la_min % 60000:05d}N'
+                     f'{lo_min // 60000:03d}{lo_min % 60000:05d}E'
+                     f'A{int(al):05d}{int(al):05d}\r\n')
+
+
+def benchmark(index, count, altitude):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "synthetic.igc")
+        writeSyntheticTrack(filename, count)
+
+        start = time.perf_counter()
+        fixes = readFixes(filename)
+        read = time.perf_counter()
+        intervals = findInfringements(index, fixes, altitude)
+        query = time.perf_counter()
+
+    # Compare with checking point by point
+    sample = min(count, 1000)
+    single_start = time.perf_counter()
+    for i in range(sample):
+        index.find(fixes["lat"][i], fixes["lon"][i])
+    single = (time.perf_counter() - single_start) / sample * count
+
+    print(f'Synthetic track with {count} fixes: {len(intervals)} intervals')
+    print(f'  read:  {read - start:.3f}s')
+    print(f'  query: {query - read:.3f}s '
+          f'({count / (query - read):.0f} fixes/s)')
+    print(f'  point by point (estimated from {sample} fixes): {single:.3f}s')
+
+
+def main():
+    global args
+
+    parser = argparse.ArgumentParser(
+        description='Check flight tracks (IGC) against an OpenAir airspace file')
+    parser.add_argument("-a", "--airspace", required=True,
+                        help="OpenAir airspace file")
+    parser.add_argument("-p", "--pressure", action="store_true",
+                        help="Use pressure altitude instead of GNSS altitude")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of tracks checked in parallel")
+    parser.add_argument("-n", "--no-arc", action="store_true",
+                        help="Resolve arcs as straight line")
+    parser.add_argument("-f", "--fast-arc", action="store_true",
+                        help="Resolve arcs with less quality (10 degree steps)")
+    parser.add_argument("--arc-tolerance", type=float, metavar="METERS",
+                        help="Resolve arcs with steps, that deviate at most METERS from the arc, instead of fixed steps")
+    parser.add_argument("--cache-dir",
+                        help="Cache parsed and resolved airspaces in this directory")
+    parser.add_argument("--benchmark", type=int, nargs="?", const=100000,
+                        help="Check a synthetic track with the given number of fixes (default 100000)")
+    parser.add_argument("-e", "--errors-only", action="store_true",
+                        help="Print only errors and no warnings")
+    parser.add_argument("igc", nargs="*",
+                        help="One or more IGC files")
+    args = parser.parse_args()
+    common.setArgs(args)
+
+    records = common.loadAirspace(args.airspace)
+    # Problems of the airspace are reported by check-consistency.py
+    with common.collectProblems():
+        common.checkHeights(records)
+    records = airspaceRecords(records)
+
+    altitude = "pressure_alt" if args.pressure else "gnss_alt"
+
+    if args.benchmark:
+        initWorker(records)
+        benchmark(index, args.benchmark, altitude)
+        return 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                initializer=initWorker,
+                                                initargs=(records,)) as executor:
+        futures = [executor.submit(checkTrack, filename, altitude)
+                   for filename in args.igc]
+        for future in futures:
+            (filename, count, infringements) = future.result()
+            print(f'{filename}: {count} fixes, {len(infringements)} infringements')
+            for (record, start, end, alt_ft) in infringements:
+                name = common.getAirspaceName2(records[record])
+                print(f'  {strTime(start)}-{strTime(end)} {name} '
+                      f'max {alt_ft:.0f}ft')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,13 +7,21 @@
 #
 
 import math
+import contextlib
+import cProfile
+import hashlib
+import json
+import os
 from pprint import pprint
+import aerofiles.openair
 from shapely.geometry import Polygon, LineString
 from shapely.validation import explain_validity
 import shapely
 import sys
 from enum import Enum
 import re
+import time
+import tracemalloc
 from icecream import ic
 import numpy as np
 
@@ -43,37 +51,336 @@ class Prio(Enum):
     WARN = 2
 
 
+#
+# Reporting of problems.
+#
+# Every problem is a Finding with its severity (prio), the id of the
+# check, that found it, its line numbers, the names of the airspaces
+# and a fingerprint. The fingerprint does not depend on line numbers,
+# so that a baseline file (args.baseline) of the fingerprints of the
+# known problems can be used to report only new problems.
+#
+# The message of a finding can be given as a function, which is only
+# called, if the message is needed. Findings are printed as text or
+# streamed as JSON Lines or SARIF (args.format).
+#
+
 problem_count = [0, 0, 0]
+collected_problems = None
+current_check = None
+baseline = None
+baseline_suppressed = 0
+ignored_messages = None
+written_fingerprints = None
+sarif_started = False
+
+
+class Finding:
+    """
+    A problem found by a check, see problem().
+
+    key is an optional hashable value. Of several findings with the same
+    key only the first one is reported (see reportFindings()).
+
+    identity is an optional JSON serializable value (or a function
+    returning it), that identifies the problem together with the check
+    id, prio and names for the fingerprint. By default the message is
+    used, which must therefore not contain line numbers.
+    """
+    __slots__ = ("prio", "check", "_message", "lineno", "lines", "names",
+                 "identity", "key")
+
+    def __init__(self, prio, message, lineno=None, key=None, check=None,
+                 lines=None, names=None, identity=None):
+        self.prio = prio
+        self.check = check
+        self._message = message
+        self.lineno = lineno
+        self.lines = lines
+        self.names = names
+        self.identity = identity
+        self.key = key
+
+    @property
+    def message(self):
+        if callable(self._message):
+            self._message = self._message()
+        return self._message
+
+    def fingerprint(self):
+        if callable(self.identity):
+            self.identity = self.identity()
+        identity = self.message if self.identity == None else self.identity
+        text = json.dumps([self.check, self.prio.name, self.names, identity])
+        return hashlib.sha256(text.encode()).hexdigest()[:20]
+
+    def isShown(self):
+        global args
+
+        if "errors_only" in args and args.errors_only:
+            return self.prio.value < Prio.WARN.value
+        return True
+
+    def prepare(self):
+        """
+        Create the message now, if it is needed later, otherwise drop
+        it, so that the finding can be sent to another process.
+        """
+        global args
+
+        ignoring = "ignore_errors" in args and args.ignore_errors != None
+        if self.isShown() or needFingerprints() or ignoring:
+            self.message
+        elif callable(self._message):
+            self._message = None
+        if needFingerprints():
+            self.fingerprint()
+        elif callable(self.identity):
+            self.identity = None
+
+    def toDict(self):
+        return {
+            "severity": self.prio.name,
+            "check": self.check,
+            "message": self.message,
+            "line": self.lineno,
+            "lines": self.lines or ([] if self.lineno == None else [self.lineno]),
+            "names": self.names or [],
+            "fingerprint": self.fingerprint(),
+        }
+
+
+@contextlib.contextmanager
+def collectProblems():
+    """
+    Collect all problems reported by problem() as a list of Finding
+    instead of printing and counting them.
+
+    with common.collectProblems() as findings:
+        ...
+    """
+    global collected_problems
+
+    previous = collected_problems
+    collected_problems = []
+    try:
+        yield collected_problems
+    finally:
+        collected_problems = previous
+
+
+@contextlib.contextmanager
+def checking(check):
+    """
+    Set the check id of all problems reported within.
+    """
+    global current_check
+
+    previous = current_check
+    current_check = check
+    try:
+        yield
+    finally:
+        current_check = previous
+
+
+def problem(prio, message, lineno=None, key=None, lines=None, names=None,
+            identity=None):
+    """
+    Report a problem.
+
+    @param message text or function returning the text
+    @param lineno line number of the problem
+    @param key see Finding
+    @param lines all line numbers involved
+    @param names names of all airspaces involved
+    @param identity see Finding
+    """
+    finding = Finding(prio, message, lineno, key, current_check,
+                      lines, names, identity)
+    if collected_problems != None:
+        collected_problems.append(finding)
+        return
+
+    reportFinding(finding)
+
+
+def reportFindings(findings, seen):
+    """
+    Print and count the given findings in their order. Findings with a
+    key already in seen are skipped.
+
+    @param seen set of the keys of the findings reported so far
+    @return number of skipped findings
+    """
+    skipped = 0
+    for finding in findings:
+        if finding.key != None:
+            if finding.key in seen:
+                skipped += 1
+                continue
+            seen.add(finding.key)
+        reportFinding(finding)
+    return skipped
+
+
+def reportProblem(prio, message, lineno=None):
+    reportFinding(Finding(prio, message, lineno, check=current_check))
+
+
+def loadBaseline(filename):
+    """
+    Read a baseline file written by --write-baseline: one fingerprint
+    per line, lines starting with # are ignored.
+
+    @return set of fingerprints
+    """
+    with open(filename) as fp:
+        return set(line.strip() for line in fp
+                   if line.strip() != "" and not line.startswith("#"))
+
+
+def needFingerprints():
+    """
+    @return True, if the fingerprints of the findings are used, i.e.
+    compared with or written into a baseline or printed as JSON Lines
+    or SARIF
+    """
+    global args
+
+    return (outputFormat() != "text" or
+            ("baseline" in args and args.baseline != None) or
+            ("write_baseline" in args and args.write_baseline != None))
+
+
+def reportFinding(finding):
+    global problem_count, args, baseline, baseline_suppressed, ignored_messages
+    global written_fingerprints
+
+    if "write_baseline" in args and args.write_baseline != None:
+        if written_fingerprints == None:
+            written_fingerprints = set()
+        written_fingerprints.add(finding.fingerprint())
+
+    if "baseline" in args and args.baseline != None:
+        if baseline == None:
+            baseline = loadBaseline(args.baseline)
+        if finding.fingerprint() in baseline:
+            baseline_suppressed += 1
+            return
 
+    if "ignore_errors" in args and args.ignore_errors != None:
+        if ignored_messages == None:
+            ignored_messages = set(args.ignore_errors)
+        if textOfFinding(finding) in ignored_messages:
+            return
 
-def problem(prio, message, lineno=None):
-    global problem_count, prio_name, args
+    if finding.isShown():
+        writeFinding(finding)
 
-    if lineno != None:
-        in_line = f', line {lineno}'
+    problem_count[finding.prio.value] = problem_count[finding.prio.value] + 1
+
+
+def textOfFinding(finding):
+    if finding.lineno != None:
+        in_line = f', line {finding.lineno}'
     else:
         in_line = ""
 
-    message = f'{prio.name}{in_line}: {message}'
+    return f'{finding.prio.name}{in_line}: {finding.message}'
 
-    if "ignore_errors" in args and args.ignore_errors != None and message in args.ignore_errors:
-        return
 
-    print_out = True
-    if "errors_only" in args and args.errors_only:
-        if prio.value >= Prio.WARN.value:
-            print_out = False
-    if print_out:
-        print(message)
+def outputFormat():
+    global args
+
+    if "format" in args and args.format != None:
+        return args.format
+    return "text"
+
+
+def infoFile():
+    """
+    @return file for informational output, that must not disturb the
+    JSON Lines or SARIF output on stdout
+    """
+    if outputFormat() == "text":
+        return sys.stdout
+    return sys.stderr
+
+
+SARIF_LEVEL = {"ERR": "error", "WARN": "warning", "OK": "note"}
+
+
+def writeFinding(finding):
+    global sarif_started
+
+    output = outputFormat()
+    if output == "text":
+        print(textOfFinding(finding))
+    elif output == "jsonl":
+        print(json.dumps(finding.toDict()))
+    elif output == "sarif":
+        # The SARIF document is streamed: the header is written before
+        # the first result and closed by finishReport()
+        if not sarif_started:
+            startSarif()
+        else:
+            sys.stdout.write(",\n")
+        result = {
+            "ruleId": finding.check,
+            "level": SARIF_LEVEL[finding.prio.name],
+            "message": {"text": finding.message},
+            "partialFingerprints": {"airspaceFingerprint/v1": finding.fingerprint()},
+        }
+        if finding.lineno != None and "filename" in args:
+            result["locations"] = [{"physicalLocation": {
+                "artifactLocation": {"uri": args.filename},
+                "region": {"startLine": finding.lineno},
+            }}]
+        if finding.names:
+            result["properties"] = {"names": finding.names}
+        sys.stdout.write(json.dumps(result))
+
+
+def startSarif():
+    global sarif_started
+
+    sarif_started = True
+    sys.stdout.write('{"$schema": "https://json.schemastore.org/sarif-2.1.0.json", '
+                     '"version": "2.1.0", "runs": [{"tool": {"driver": '
+                     '{"name": "check-consistency", '
+                     '"informationUri": "https://github.com/bubeck/airspace_germany"}}, '
+                     '"results": [\n')
+
+
+def finishReport():
+    """
+    Finish the output of all findings (close the SARIF document and
+    write the baseline file, if requested).
+    """
+    global args
+
+    if outputFormat() == "sarif":
+        if not sarif_started:
+            startSarif()
+        sys.stdout.write("\n]}]}\n")
 
-    problem_count[prio.value] = problem_count[prio.value] + 1
+    if "write_baseline" in args and args.write_baseline != None:
+        with open(args.write_baseline, "w") as fp:
+            fp.write("# Fingerprints of known problems, see --baseline\n")
+            for fingerprint in sorted(written_fingerprints or []):
+                fp.write(fingerprint + "\n")
+
+    if baseline_suppressed > 0:
+        print(f'{baseline_suppressed} known problems suppressed by baseline',
+              file=infoFile())
 
 
 def printProblemCounts():
     global problem_count, prio_name
 
     for prio in Prio:
-        print(f'{problem_count[prio.value]} {prio.name}')
+        print(f'{problem_count[prio.value]} {prio.name}', file=infoFile())
 
     return problem_count[prio.ERR.value] > 0
 
@@ -92,24 +399,101 @@ def intersectsInHeight(record1, record2):
     return iH(record1, record2) or iH(record2, record1)
 
 
-def getOverlappingAirspaces(records):
+def iHIndex(floor1, ceiling1, floor2, ceiling2):
+    return (((ceiling1 > floor2) & (ceiling1 < ceiling2)) |
+            ((floor1 >= floor2) & (floor1 < ceiling2)) |
+            ((floor1 >= floor2) & (ceiling1 < ceiling2)))
+
+
+def intersectsInHeightIndex(floor_ft, ceiling_ft, i, j):
+    """
+    Vectorized version of intersectsInHeight() working on the height bands
+    of all records at once.
+
+    @param floor_ft array of the floor of all records in feet
+    @param ceiling_ft array of the ceiling of all records in feet
+    @param i, j arrays of indices of the pairs of records to check
+
+    @return boolean array, which pairs intersect in height
+    """
+    (floor1, ceiling1) = (floor_ft[i], ceiling_ft[i])
+    (floor2, ceiling2) = (floor_ft[j], ceiling_ft[j])
+    return (iHIndex(floor1, ceiling1, floor2, ceiling2) |
+            iHIndex(floor2, ceiling2, floor1, ceiling1))
+
+
+def reportInvalidOverlap(record1, record2, error):
+    problem(Prio.ERR, "Invalid Overlapping Airspaces " +
+            getAirspaceName2(record1) + ", " +
+            getAirspaceName2(record2) + f': {error}',
+            names=[getAirspaceName2(record1), getAirspaceName2(record2)])
+
+
+def getOverlappingAirspaces(records, subset=None, failed=None):
+    """
+    Find all pairs of airspaces, that overlap in their area and in height.
+
+    Instead of comparing every record with every other one, the polygons are
+    put into a STRtree. Only pairs whose bounding boxes intersect are
+    then filtered by their height bands (see intersectsInHeightIndex()) and
+    only the remaining pairs are checked exactly.
+
+    @param subset if given, only the pairs with at least one of these
+    records (list of indices into records) are checked
+    @param failed if given, the pairs, whose intersection failed, are
+    appended as (record1, record2, error) instead of being reported
+    """
     overlap = []
-    num_records = len(records)
-    for i in range(0, num_records):
-        record1 = records[i]
-        for j in range(i+1, num_records):
-            record2 = records[j]
-            if intersectsInHeight(record1, record2):
-                if record1["polygon"].intersects(record2["polygon"]):
-                    try:
-                        intersection = shapely.intersection(
-                            record1["polygon"], record2["polygon"])
-                        area = intersection.area
-                        if area > 0:
-                            overlap.append([record1, record2])
-                    except shapely.errors.GEOSException as e:
-                        problem(Prio.ERR, "Invalid Overlapping Airspaces " +
-                                getAirspaceName2(record1) + ", " + getAirspaceName2(record2), e)
+    indexed = [record for record in records if "polygon" in record]
+    if len(indexed) < 2:
+        return overlap
+
+    polygons = np.array([record["polygon"] for record in indexed])
+    tree = shapely.STRtree(polygons)
+    (i, j) = tree.query(polygons)
+
+    # Every pair is reported twice (and every polygon with itself),
+    # keep the ordering i < j as done by the exhaustive search.
+    mask = i < j
+    if subset != None:
+        selected = np.zeros(len(records), dtype=bool)
+        selected[subset] = True
+        selected = selected[[k for (k, record) in enumerate(records)
+                             if "polygon" in record]]
+        mask &= selected[i] | selected[j]
+    i = i[mask]
+    j = j[mask]
+    profileCount("bbox pairs", len(i))
+
+    floor_ft = np.array([record["floor_ft"]
+                        for record in indexed], dtype=float)
+    ceiling_ft = np.array([record["ceiling_ft"]
+                          for record in indexed], dtype=float)
+    mask = intersectsInHeightIndex(floor_ft, ceiling_ft, i, j)
+    i = i[mask]
+    j = j[mask]
+    profileCount("height pairs", len(i))
+
+    mask = shapely.intersects(polygons[i], polygons[j])
+    i = i[mask]
+    j = j[mask]
+    profileCount("intersecting pairs", len(i))
+
+    order = np.lexsort((j, i))
+    for i, j in zip(i[order].tolist(), j[order].tolist()):
+        record1 = indexed[i]
+        record2 = indexed[j]
+        try:
+            intersection = shapely.intersection(
+                record1["polygon"], record2["polygon"])
+            area = intersection.area
+            if area > 0:
+                overlap.append([record1, record2])
+        except shapely.errors.GEOSException as e:
+            if failed != None:
+                failed.append([record1, record2, str(e)])
+            else:
+                reportInvalidOverlap(record1, record2, str(e))
 
     return overlap
 
@@ -192,10 +576,12 @@ def checkHeights(records):
                 prio = checkHeight(record, h)
                 if prio.value > Prio.OK.value:
                     problem(
-                        prio, f'Height "{record[h]}" in {getAirspaceName2(record)}')
+                        prio, f'Height "{record[h]}" in {getAirspaceName2(record)}',
+                        names=[getAirspaceName2(record)])
             else:
                 problem(
-                    Prio.ERR, f'Missing height "{h}" in {getAirspaceName2(record)}')
+                    Prio.ERR, f'Missing height "{h}" in {getAirspaceName2(record)}',
+                    names=[getAirspaceName2(record)])
 
 
 def getAirspaceName(record):
@@ -302,6 +688,101 @@ def get_kx_ky(lat):
     return (kx, ky)
 
 
+class PointGrid:
+    """
+    Uniform grid over latitude and longitude to find all points, that
+    are closer than distance_m to a given point, without comparing
+    against all points. The cell size is chosen, so that all points
+    closer than distance_m (measured with geo_distance()) are found in
+    the neighbouring cells.
+    """
+
+    def __init__(self, coords, distance_m):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.distance_m = distance_m
+        if len(self.coords) > 0:
+            self.max_lat = float(np.abs(self.coords[:, 0]).max())
+        else:
+            self.max_lat = 0
+        (self.cell_lat, self.cell_lon) = self.reach(self.max_lat)
+
+        self.cells = {}
+        cells = np.floor(self.coords / (self.cell_lat, self.cell_lon))
+        for (i, cell) in enumerate(cells.astype(np.int64).tolist()):
+            self.cells.setdefault(tuple(cell), []).append(i)
+
+    def reach(self, lat):
+        """
+        @return maximum difference in latitude and longitude of two points
+        closer than distance_m, if none of them is beyond latitude lat.
+        """
+        # Add some margin against rounding errors in geo_distance()
+        distance_km = self.distance_m / 1000 * 1.001
+        (_, ky) = get_kx_ky(0)      # ky is minimal at the equator
+        (kx, _) = get_kx_ky(min(abs(lat), 89.9))
+        return (distance_km / ky, distance_km / kx)
+
+    def query(self, lat, lon):
+        """
+        Find all points near the given point.
+
+        @return sorted list of the indices of all points, which may be
+        closer than distance_m.
+        """
+        (reach_lat, reach_lon) = self.reach(max(abs(lat), self.max_lat))
+        lat_range = range(math.floor((lat - reach_lat) / self.cell_lat),
+                          math.floor((lat + reach_lat) / self.cell_lat) + 1)
+        lon_range = range(math.floor((lon - reach_lon) / self.cell_lon),
+                          math.floor((lon + reach_lon) / self.cell_lon) + 1)
+        result = []
+        for cell_lat in lat_range:
+            for cell_lon in lon_range:
+                if (cell_lat, cell_lon) in self.cells:
+                    result.extend(self.cells[(cell_lat, cell_lon)])
+        result.sort()
+        return result
+
+
+def clusterPoints(coords, distance_m):
+    """
+    Merge all points, that are closer than distance_m (but not
+    identical), into clusters. Two points are in the same cluster, if
+    they are connected by a chain of close points, so a cluster may be
+    wider than distance_m.
+
+    The close pairs are found by a PointGrid and merged by union-find.
+
+    @param coords array of shape (N, 2) of unique points
+    @return array of shape (N,) with the smallest index of the cluster
+    of every point
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    parent = list(range(len(coords)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    grid = PointGrid(coords, distance_m)
+    for (i, (lat1, lon1)) in enumerate(coords.tolist()):
+        candidates = [j for j in grid.query(lat1, lon1) if j > i]
+        profileCount("distance evaluations", len(candidates))
+        for j in candidates:
+            (lat2, lon2) = coords[j].tolist()
+            (distance_cm, bearing) = geo_distance(lat1, lon1, lat2, lon2)
+            if 0 < distance_cm / 100 < distance_m:
+                (root1, root2) = (find(i), find(j))
+                # The smaller index becomes the root
+                if root1 < root2:
+                    parent[root2] = root1
+                elif root2 < root1:
+                    parent[root1] = root2
+
+    return np.array([find(i) for i in range(len(coords))], dtype=np.int64)
+
+
 def decimal_degrees_to_dms(decimal_degrees):
     # mnt,sec = divmod(decimal_degrees*3600,60)
     # deg,mnt = divmod(mnt, 60)
@@ -392,37 +873,113 @@ def resolveRecordArcs(records):
         resolveArcs(record)
 
 
-def resolveArcs(record):
+class Airspace:
+    """
+    The resolved ring of an airspace with all arcs and circles resolved
+    into points. The points are stored in contiguous arrays:
+
+    coords    float64 array of shape (N, 2) with latitude and longitude
+    computed  bool array of shape (N,), True if computed from an arc
+    lineno    int array of shape (N,) with the line number of the
+              element, the point was created from (or -1)
+
+    For existing code, it also behaves like a list of point elements
+    (e.g. {"type": "point", "location": [lat, lon], "computed": False}).
+    """
+
+    __slots__ = ("coords", "computed", "lineno")
+
+    def __init__(self, coords, computed, lineno):
+        self.coords = coords
+        self.computed = computed
+        self.lineno = lineno
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, i):
+        element = createElementPoint(
+            float(self.coords[i, 0]), float(self.coords[i, 1]))
+        element["computed"] = bool(self.computed[i])
+        if self.lineno[i] >= 0:
+            element["lineno"] = int(self.lineno[i])
+        return element
+
+    def __iter__(self):
+        for i in range(len(self.coords)):
+            yield self[i]
+
+
+def resolveArcs(record, fixed_steps=False):
+    """
+    Resolve all arcs and circles of the record into points, with the
+    steps given by the options (see resolve_DA_coords()).
+
+    @param fixed_steps True to use fixed steps even with --arc-tolerance
+
+    @return the resolved Airspace, which is also stored as
+    record["elements_resolved"]
+    """
     global args
 
-    elements_resolved = []
+    tolerance_m = None if fixed_steps else arcTolerance()
+    coords = []
+    computed = []
+
     for element in record["elements"]:
         if element["type"] == "point":
-            element["computed"] = False
-            elements_resolved.append(element)
+            coords.append([element["location"]])
+            computed.append([False])
             # print(f'resolve(point, {strLatLon(element["location"])}')
         elif element["type"] == "arc":
             if not args.no_arc:
                 if "radius" in element:
-                    elements_resolved.extend(resolve_DA(element["center"], nautical_miles_to_km(
-                        element["radius"]), element["start"], element["end"], element["clockwise"], True))
+                    arc = resolve_DA_coords(element["center"], nautical_miles_to_km(
+                        element["radius"]), element["start"], element["end"], element["clockwise"], True,
+                        tolerance_m=tolerance_m)
+                    coords.append(arc)
+                    computed.append(np.ones(len(arc), dtype=bool))
                 else:
-                    elements_resolved.extend(resolve_DB(
-                        element["center"], element["start"], element["end"], element["clockwise"]))
+                    arc = resolve_DB_coords(
+                        element["center"], element["start"], element["end"], element["clockwise"],
+                        tolerance_m)
+                    coords.append(arc)
+                    arc_computed = np.ones(len(arc), dtype=bool)
+                    arc_computed[[0, -1]] = False
+                    computed.append(arc_computed)
             else:
                 # ic(element)
-                elements_resolved.append(createElementPoint(
-                    element["start"][0], element["start"][1]))
-                elements_resolved.append(createElementPoint(
-                    element["end"][0], element["end"][1]))
+                coords.append([element["start"], element["end"]])
+                computed.append([False, False])
         elif element["type"] == "circle":
-            elements_resolved.extend(resolve_circle(element))
+            circle = resolve_circle_coords(element, tolerance_m)
+            coords.append(circle)
+            computed.append(np.ones(len(circle), dtype=bool))
         else:
             print(f'Unknown element type: {element["type"]}')
             sys.exit(1)
 
-    record["elements_resolved"] = elements_resolved
-    return elements_resolved
+    linenos = [np.full(len(c), element.get("lineno", -1), dtype=np.int64)
+               for (c, element) in zip(coords, record["elements"])]
+
+    if len(coords) > 0:
+        airspace = Airspace(np.concatenate(coords).astype(np.float64).reshape(-1, 2),
+                            np.concatenate(computed).astype(bool),
+                            np.concatenate(linenos))
+    else:
+        airspace = Airspace(np.empty((0, 2)), np.empty(0, dtype=bool),
+                            np.empty(0, dtype=np.int64))
+
+    record["elements_resolved"] = airspace
+    return airspace
+
+
+def countFixedStepPoints(records):
+    """
+    Count the points of all records resolved with fixed steps (as
+    without --arc-tolerance) to compare them with the current ones.
+    """
+    return sum(len(resolveArcs(dict(record), fixed_steps=True)) for record in records)
 
 
 def createElementPoint(lat, lon):
@@ -432,9 +989,93 @@ def createElementPoint(lat, lon):
     return element
 
 
+def createElementPoints(coords, computed):
+    """
+    Convert an array of coordinates as returned by the resolve_*_coords()
+    functions into a list of point elements.
+
+    @param coords array of shape (N, 2) with latitude and longitude
+    @param computed value of "computed" for all created elements
+    """
+    elements = []
+    for (lat, lon) in coords.tolist():
+        element = createElementPoint(lat, lon)
+        element["computed"] = computed
+        elements.append(element)
+    return elements
+
+
+def geo_destination_coords(lat1, lon1, angles, distances_km):
+    """
+    Vectorized version of geo_destination() for many angles and
+    distances around the same point.
+
+    @return array of shape (N, 2) with latitude and longitude
+    """
+    angles = np.radians(angles)
+    dx = np.sin(angles) * distances_km
+    dy = np.cos(angles) * distances_km
+
+    (kx, ky) = get_kx_ky(lat1)
+
+    coords = np.empty((len(angles), 2))
+    coords[:, 0] = lat1 + dy / ky
+    coords[:, 1] = lon1 + dx / kx
+    return coords
+
+
 def resolve_DA(center, radius_km, start_angle, end_angle, clockwise, use_edge, radius_km_end=None):
+    coords = resolve_DA_coords(center, radius_km, start_angle,
+                               end_angle, clockwise, use_edge, radius_km_end, arcTolerance())
+    return createElementPoints(coords, True)
+
+
+# Largest step in degrees used with --arc-tolerance, so that even very
+# small circles keep their shape
+MAX_ARC_STEP = 45
+
+
+def arcTolerance():
+    """
+    @return maximum deviation in m of the resolved arcs from the real
+    ones given by --arc-tolerance or None for fixed steps
+    """
+    global args
+
+    if "arc_tolerance" in args and args.arc_tolerance != None:
+        return args.arc_tolerance
+    return None
+
+
+def arcStep(radius_km, tolerance_m):
+    """
+    Calculate the step in degrees, so that the chords between the points
+    of an arc with the given radius deviate at most by tolerance_m
+    from the arc: the sagitta r * (1 - cos(step / 2)) of the chord must
+    not be larger than the tolerance.
+    """
+    radius_m = radius_km * 1000
+    if radius_m <= tolerance_m:
+        return MAX_ARC_STEP
+    step = math.degrees(2 * math.acos(1 - tolerance_m / radius_m))
+    return min(step, MAX_ARC_STEP)
+
+
+def resolve_DA_coords(center, radius_km, start_angle, end_angle, clockwise, use_edge, radius_km_end=None,
+                      tolerance_m=None):
+    """
+    Compute all points of an arc around center in one array operation.
+
+    The angles are stepped in 1 degree (or 10 degree with --fast-arc)
+    from start_angle to end_angle (excluding). If tolerance_m (the
+    value of --arc-tolerance) is given, the arc is divided into equal
+    steps, that are small enough for this maximum deviation in m (see
+    arcStep()). The radius is linearly interpolated from radius_km to
+    radius_km_end.
+
+    @return array of shape (N, 2) with latitude and longitude
+    """
     global args
-    elements = []
 
     if radius_km_end == None:
         radius_km_end = radius_km
@@ -443,77 +1084,84 @@ def resolve_DA(center, radius_km, start_angle, end_angle, clockwise, use_edge, r
         reverse = False
     else:
         reverse = True
-        clockwise = True
-        tmp = start_angle
-        start_angle = end_angle
-        end_angle = tmp
-
-    if args.fast_arc:
-        dir = 10
-    else:
-        dir = 1
-
-    if clockwise:
-        while start_angle > end_angle:
-            end_angle = end_angle + 360
+        start_angle, end_angle = end_angle, start_angle
+
+    while start_angle > end_angle:
+        end_angle = end_angle + 360
+
+    if tolerance_m != None:
+        span = end_angle - start_angle
+        if span <= 0:
+            return np.empty((0, 2))
+        count = math.ceil(
+            span / arcStep(max(radius_km, radius_km_end), tolerance_m))
+        k = np.arange(0 if use_edge else 1, count)
+        angles = start_angle + span * k / count
     else:
-        dir = -dir
-        while start_angle < end_angle:
-            start_angle = start_angle + 360
-
-    # print("start_angle:", start_angle)
-    # print("end_angle:", end_angle)
-    # print("clockwise:", clockwise)
-    # print("radius_km:", radius_km)
-    # print("radius_km_e:", radius_km_end)
-
-    if not use_edge:
-        start_angle = start_angle + dir
-        end_angle = end_angle - dir
-
-    angle = start_angle
-
-    while True:
-        # print("loop angle:", angle)
-        if clockwise:
-            if angle >= end_angle:
-                angle = end_angle
-                break
+        if args.fast_arc:
+            dir = 10
         else:
-            if angle <= end_angle:
-                angle = end_angle
-                break
-
-        # distance = radius_km
-        t = (angle - start_angle) / (end_angle - start_angle)
-        if reverse:
-            t = 1 - t
-        # ic(t)
-        distance = radius_km + t * (radius_km_end - radius_km)
-        # ic(distance)
-
-        (lat, lon) = geo_destination(center[0], center[1], angle, distance)
-        # print(f'lat={lat} lon={lon}')
-        element = createElementPoint(lat, lon)
-        element["computed"] = True
-        elements.append(element)
-        angle = angle + dir
+            dir = 1
+
+        if not use_edge:
+            start_angle = start_angle + dir
+            end_angle = end_angle - dir
+
+        if start_angle >= end_angle:
+            return np.empty((0, 2))
+
+        # The angles are summed up step by step (and not computed as
+        # start_angle + k * dir) to get exactly the same rounding as
+        # a loop adding dir to the angle.
+        count = int((end_angle - start_angle) / dir) + 2
+        steps = np.full(count, dir, dtype=float)
+        steps[0] = start_angle
+        angles = np.add.accumulate(steps)
+        angles = angles[angles < end_angle]
+
+    if len(angles) == 0:
+        return np.empty((0, 2))
 
+    t = (angles - start_angle) / (end_angle - start_angle)
     if reverse:
-        elements.reverse()
+        t = 1 - t
+    distances = radius_km + t * (radius_km_end - radius_km)
 
-    return elements
+    coords = geo_destination_coords(center[0], center[1], angles, distances)
+
+    if reverse:
+        coords = coords[::-1]
+
+    return coords
 
 
 def resolve_circle(element):
+    return createElementPoints(resolve_circle_coords(element, arcTolerance()), True)
+
+
+def resolve_circle_coords(element, tolerance_m=None):
     center = element["center"]
     radius_km = nautical_miles_to_km(element["radius"])
-    elements = resolve_DA(center, radius_km, 0, 180, True, True)
-    elements.extend(resolve_DA(center, radius_km, 180, 0, True, True))
-    return elements
+    return np.concatenate((resolve_DA_coords(center, radius_km, 0, 180, True, True, tolerance_m=tolerance_m),
+                           resolve_DA_coords(center, radius_km, 180, 0, True, True, tolerance_m=tolerance_m)))
 
 
 def resolve_DB(center, start, end, clockwise):
+    coords = resolve_DB_coords(center, start, end, clockwise, arcTolerance())
+    elements = createElementPoints(coords, True)
+    elements[0]["computed"] = False
+    elements[-1]["computed"] = False
+    return elements
+
+
+def resolve_DB_coords(center, start, end, clockwise, tolerance_m=None):
+    """
+    Compute all points of a DB arc. The first and the last point
+    are the given start and end point, all others are computed
+    (see resolve_DA_coords() for tolerance_m).
+
+    @return array of shape (N, 2) with latitude and longitude
+    """
 
     (dist_s, bearing_s) = geo_distance(
         center[0], center[1], start[0], start[1])
@@ -522,16 +1170,9 @@ def resolve_DB(center, start, end, clockwise):
     dist_s_km = (dist_s / 100) / 1000
     dist_e_km = (dist_e / 100) / 1000
 
-    elements = resolve_DA(center, dist_s_km, bearing_s,
-                          bearing_e, clockwise, False, dist_e_km)
-    element = createElementPoint(start[0], start[1])
-    element["computed"] = False
-    elements.insert(0, element)
-    element = createElementPoint(end[0], end[1])
-    element["computed"] = False
-    elements.append(element)
-
-    return elements
+    arc = resolve_DA_coords(center, dist_s_km, bearing_s,
+                            bearing_e, clockwise, False, dist_e_km, tolerance_m)
+    return np.concatenate(([start], arc, [end]))
 
 
 def createPolygons(records):
@@ -540,16 +1181,12 @@ def createPolygons(records):
 
 
 def createPolygonOfRecord(record):
-    points = []
+    coords = record["elements_resolved"].coords
 
-    for element in record["elements_resolved"]:
-        points.append(element["location"])
-        # print(element["location"])
-    # ic(record)
-    if len(points) < 3:
+    if len(coords) < 3:
         problem(Prio.ERR, getAirspaceName2(record), "has too less points.")
         return
-    record["polygon"] = Polygon(points)
+    record["polygon"] = Polygon(coords)
 
 
 def findLowestXY(record):
@@ -559,10 +1196,97 @@ def findLowestXY(record):
         record["min_y"] = 0
         return
 
-    coords = list(record["polygon"].exterior.coords)
+    (min_x, min_y) = record["elements_resolved"].coords.min(axis=0)
+
+    record["min_x"] = float(min_x)
+    record["min_y"] = float(min_y)
+
+
+class AirspaceIndex:
+    """
+    Spatial index over the polygons of the given records to find all
+    airspaces containing a point. The polygons are prepared and put
+    into a STRtree once, so that single points as well as whole arrays
+    of points (e.g. a flight track) are answered quickly.
+
+    Points are given as latitude and longitude, like all coordinates
+    of the records.
+    """
+
+    def __init__(self, records):
+        self.records = [record for record in records if "polygon" in record]
+        polygons = np.array([record["polygon"] for record in self.records],
+                            dtype=object)
+        shapely.prepare(polygons)
+        self.tree = shapely.STRtree(polygons)
+        self.has_ft = np.array(["floor_ft" in record for record in self.records],
+                               dtype=bool)
+        self.floor_ft = np.array([record.get("floor_ft", 0) for record in self.records],
+                                 dtype=float)
+        self.ceiling_ft = np.array([record.get("ceiling_ft", np.nan) for record in self.records],
+                                   dtype=float)
+
+    def find(self, lat, lon):
+        """
+        Find all airspaces containing the given point.
+
+        @return list of records sorted by "floor_ft" (if all of them have it)
+        """
+        indices = np.sort(self.tree.query(
+            shapely.points(lat, lon), predicate="within"))
+        if self.has_ft[indices].all():
+            indices = indices[np.argsort(
+                self.floor_ft[indices], kind="stable")]
+        return [self.records[i] for i in indices.tolist()]
+
+    def find_many(self, coords):
+        """
+        Find all airspaces containing any of the given points in one call.
+
+        @param coords array of shape (N, 2) with latitude and longitude
+
+        @return arrays (points, records) of the same length with the index
+        of the point in coords and the index of the record in
+        self.records for every point inside an airspace. They are sorted
+        by point and for each point by "floor_ft".
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        (points, records) = self.tree.query(
+            shapely.points(coords), predicate="within")
+        order = np.lexsort((records, self.floor_ft[records], points))
+        return (points[order], records[order])
+
+
+def buildCoordinateIndex(records, centers=False):
+    """
+    Build an index of all coordinates used by the elements of all records.
+    Points, start and end of arcs and centers of circles are indexed.
+
+    @param centers True to index the centers (V X=) of all arcs as well
+    @return dict mapping (lat, lon) to a list of (record, element, lineno)
+    """
 
-    record["min_x"] = min(x for x, y in coords)
-    record["min_y"] = min(y for x, y in coords)
+    index = {}
+    for record in records:
+        for element in record["elements"]:
+            if element["type"] == "circle":
+                locations = [element["center"]]
+            elif element["type"] == "point":
+                locations = [element["location"]]
+            elif element["type"] == "arc" and not "radius" in element:
+                # DB only, start and end of DA are angles
+                locations = [element["start"], element["end"]]
+                if centers:
+                    locations.insert(0, element["center"])
+            elif element["type"] == "arc" and centers:
+                locations = [element["center"]]
+            else:
+                continue
+            lineno = element.get("lineno")
+            for location in locations:
+                index.setdefault(tuple(location), []).append(
+                    (record, element, lineno))
+    return index
 
 
 def find_airspace(records, name):
@@ -570,3 +1294,852 @@ def find_airspace(records, name):
         if getAirspaceName2(record) == name:
             return record
     return None
+
+
+#
+# Difference between two versions of an airspace file.
+#
+# Records are first matched exactly by their key (name, class, heights
+# and the WKB of the normalized polygon). Only the remaining records
+# are compared by the Jaccard similarity of their polygons and only
+# with the records, whose bounding boxes intersect.
+#
+
+def diffKeys(records):
+    """
+    @return list with the key of every record, two records with the same
+    key are identical
+    """
+    polygons = np.array([record.get("polygon") for record in records],
+                        dtype=object)
+    wkb = shapely.to_wkb(shapely.normalize(polygons))
+    return [(record.get("name"), record.get("class"),
+             record.get("floor"), record.get("ceiling"), w)
+            for (record, w) in zip(records, wkb.tolist())]
+
+
+def jaccardScores(polygons1, polygons2):
+    """
+    Compute the Jaccard similarity (0-100%) of all pairs of polygons with
+    intersecting bounding boxes. Invalid polygons are never similar.
+
+    @return arrays (i, j, score) for every pair polygons1[i], polygons2[j]
+    """
+    valid1 = np.flatnonzero(shapely.is_valid(polygons1))
+    valid2 = np.flatnonzero(shapely.is_valid(polygons2))
+    tree = shapely.STRtree(polygons2[valid2])
+    (i, j) = tree.query(polygons1[valid1])
+    i = valid1[i]
+    j = valid2[j]
+
+    p1 = polygons1[i]
+    p2 = polygons2[j]
+    intersection = shapely.area(shapely.intersection(p1, p2))
+    union = shapely.area(shapely.union(p1, p2))
+    score = np.divide(intersection, union, out=np.zeros(len(i)),
+                      where=union > 0) * 100
+    score[shapely.equals(p1, p2)] = 100
+    return (i, j, score)
+
+
+def diffAirspaces(records_old, records_new, changed=90):
+    """
+    Compare two versions of an airspace.
+
+    Every old record is either identical to a new record, changed (it
+    is paired with a new record, preferably with the same name, with a
+    similarity of more than changed percent) or removed. Every new
+    record is part of at most one pair, all others are added.
+
+    @param records_old records of the old version
+    @param records_new records of the new version
+    @param changed minimal similarity in percent of a changed record
+
+    @return dict with the lists "identical" (pairs of old and new
+    record), "changed" (old record, new record, similarity), "removed"
+    (old records) and "added" (new records)
+    """
+
+    result = {"identical": [], "changed": [], "removed": [], "added": []}
+
+    new_by_key = {}
+    for (j, key) in enumerate(diffKeys(records_new)):
+        new_by_key.setdefault(key, []).append(j)
+
+    matched_new = set()
+    remaining_old = []
+    for (i, key) in enumerate(diffKeys(records_old)):
+        candidates = new_by_key.get(key)
+        if candidates:
+            j = candidates.pop(0)
+            matched_new.add(j)
+            result["identical"].append((records_old[i], records_new[j]))
+        else:
+            remaining_old.append(i)
+
+    with_polygon = [i for i in remaining_old if "polygon" in records_old[i]]
+    remaining_new = [j for j in range(len(records_new))
+                     if j not in matched_new and "polygon" in records_new[j]]
+    polygons_old = np.array([records_old[i]["polygon"] for i in with_polygon],
+                            dtype=object)
+    polygons_new = np.array([records_new[j]["polygon"] for j in remaining_new],
+                            dtype=object)
+    (k, l, score) = jaccardScores(polygons_old, polygons_new)
+
+    # Pairs are matched greedily, the most similar first, so that every
+    # record is part of at most one pair. A pair with the same name is
+    # preferred over a more similar one with another name (e.g. a D
+    # above a CTR with the same lateral limits), as long as it is
+    # similar enough. The first one is taken on ties.
+    names_old = np.array([records_old[i].get("name") for i in with_polygon] + [None],
+                         dtype=object)
+    names_new = np.array([records_new[j].get("name") for j in remaining_new] + [None],
+                         dtype=object)
+    similar = score > changed
+    (k, l, score) = (k[similar], l[similar], score[similar])
+    same_name = names_old[k] == names_new[l]
+    order = np.lexsort((l, k, -score, ~same_name))
+    best = {}
+    for (k, l, score) in zip(k[order].tolist(), l[order].tolist(),
+                             score[order].tolist()):
+        (i, j) = (with_polygon[k], remaining_new[l])
+        if i not in best and j not in matched_new:
+            best[i] = (j, score)
+            matched_new.add(j)
+
+    # Old records without polygon are either identical or removed
+    for i in remaining_old:
+        if i in best:
+            (j, score) = best[i]
+            result["changed"].append((records_old[i], records_new[j], score))
+        else:
+            result["removed"].append(records_old[i])
+
+    result["added"] = [record for (j, record) in enumerate(records_new)
+                       if j not in matched_new]
+    return result
+
+
+def getAirspaceLine(record):
+    """
+    @return line number of the first element of the record or None
+    """
+    if len(record["elements"]) > 0:
+        return record["elements"][0].get("lineno")
+    return None
+
+
+def printDiff(diff):
+    """
+    Print the result of diffAirspaces() as a report.
+    """
+    for (record_old, record_new, score) in diff["changed"]:
+        print(f'CHANGED: {getAirspaceName2(record_old)} (line {getAirspaceLine(record_old)})'
+              f' -> {getAirspaceName2(record_new)} (line {getAirspaceLine(record_new)}), {score:.1f}% similar')
+    for record in diff["removed"]:
+        print(f'REMOVED: {getAirspaceName2(record)}'
+              f' (line {getAirspaceLine(record)})')
+    for record in diff["added"]:
+        print(f'ADDED: {getAirspaceName2(record)}'
+              f' (line {getAirspaceLine(record)})')
+    print(f'{len(diff["identical"])} identical, {len(diff["changed"])} changed, '
+          f'{len(diff["removed"])} removed, {len(diff["added"])} added')
+
+
+#
+# Native OpenAir parser.
+#
+# The statements, that make up nearly all of a typical OpenAir file
+# (AC, AN, AH, AL, DP, DB, DC and V X=/V D=) are parsed directly. All
+# other statements (and all statements, that fail to parse) are given
+# to aerofiles, so that the result and the errors are identical to
+# aerofiles.openair.Reader.
+#
+
+COORDINATE_FORMAT = re.compile(
+    r'\s*(\d+):(\d+):(\d+(?:\.\d+)?)\s*([NS])\s*(\d+):(\d+):(\d+(?:\.\d+)?)\s*([EW])\s*')
+
+
+def parseCoordinate(value):
+    """
+    Same as aerofiles.openair.reader.coordinate(), but faster for the
+    usual format DD:MM:SS N DDD:MM:SS E.
+
+    @return tuple (lat, lon)
+    """
+    match = COORDINATE_FORMAT.match(value)
+    if not match:
+        return tuple(aerofiles.openair.reader.coordinate(value))
+    g = match.groups()
+    lat = int(g[0]) + int(g[1]) / 60. + float(g[2]) / 3600.
+    if g[3] == 'S':
+        lat = -lat
+    lon = int(g[4]) + int(g[5]) / 60. + float(g[6]) / 3600.
+    if g[7] == 'W':
+        lon = -lon
+    return (lat, lon)
+
+
+class OpenAirReader(aerofiles.openair.Reader):
+    """
+    Streaming reader for OpenAir files, that returns the same records
+    as aerofiles.openair.Reader, but is much faster::
+
+        with open('airspace.txt', encoding='latin-1', newline='') as fp:
+            for record, error in OpenAirReader(fp):
+                if error:
+                    raise error
+    """
+
+    def __init__(self, fp):
+        super().__init__(fp)
+        self.coordinates = {}
+
+    def coordinate(self, value):
+        """
+        Same as aerofiles.openair.reader.coordinate(), but with a
+        cache, as most coordinates are used several times.
+        """
+        location = self.coordinates.get(value)
+        if location == None:
+            location = parseCoordinate(value)
+            self.coordinates[value] = location
+        return list(location)
+
+    def next(self):
+        state = self.State()
+        lineno = 0
+
+        # Iterating over the file reads it buffered in chunks
+        for line in self.reader.fp:
+            lineno += 1
+
+            # Ignore comments
+            pos = line.find('*')
+            if pos >= 0:
+                line = line[:pos]
+            line = line.strip()
+            if line == '':
+                continue
+
+            parts = line.split(' ', 1)
+            line_type = parts[0]
+            value = None if len(parts) < 2 else parts[1]
+
+            if line_type in ('AC', 'TC', 'TO') and state.is_ready():
+                yield state.record, None
+                state.reset()
+
+            if not state.record:
+                if line_type == 'AC':
+                    state.reset_airspace()
+                elif line_type in ('TC', 'TO'):
+                    state.reset_terrain(line_type == 'TO')
+                else:
+                    # Lines outside of records are only checked for errors
+                    (_, error) = self.parse_fallback(line, lineno)
+                    if error:
+                        yield None, error
+                    continue
+
+            try:
+                self.handle_fast(line_type, value, lineno, state)
+                continue
+            except Exception:
+                # Unknown statement or error: let aerofiles handle it
+                pass
+
+            (parsed, error) = self.parse_fallback(line, lineno)
+            if error:
+                yield None, error
+                state.reset()
+                continue
+            try:
+                self.handle_line(parsed, state)
+            except Exception as e:
+                e.lineno = lineno
+                yield None, e
+                state.reset()
+
+        # We finished parsing. Yield last record iff ready:
+        if state.is_ready():
+            yield state.record, None
+
+    def parse_fallback(self, line, lineno):
+        self.reader.lineno = lineno
+        try:
+            return (self.reader.parse_line(line), None)
+        except Exception as e:
+            e.lineno = lineno
+            return (None, e)
+
+    def handle_fast(self, line_type, value, lineno, state):
+        """
+        Handle the most common statements directly.
+
+        @raise ValueError for all statements, that are not handled
+        """
+        record = state.record
+
+        if line_type == 'DP':
+            record['elements'].append({
+                "type": "point",
+                "location": self.coordinate(value),
+                "lineno": lineno,
+            })
+        elif line_type == 'V':
+            (name, value) = value.split('=')
+            name = name.strip()
+            value = value.strip()
+            if name == 'X':
+                state.center = self.coordinate(value)
+            elif name == 'D' and value.startswith('+'):
+                state.clockwise = True
+            elif name == 'D' and value.startswith('-'):
+                state.clockwise = False
+            else:
+                raise ValueError(line_type)
+        elif line_type == 'DB':
+            (start, end) = value.split(',')
+            record['elements'].append({
+                "type": "arc",
+                "center": state.center,
+                "clockwise": state.clockwise,
+                "start": self.coordinate(start.strip()),
+                "end": self.coordinate(end.strip()),
+                "lineno": lineno,
+            })
+        elif line_type == 'DC':
+            if not state.center:
+                raise ValueError('center undefined')
+            record['elements'].append({
+                "type": "circle",
+                "center": state.center,
+                "radius": float(value),
+                "lineno": lineno,
+            })
+        elif line_type == 'AC' and record["type"] == "airspace":
+            record["class"] = value
+        elif line_type == 'AN':
+            record["name"] = value
+        elif line_type == 'AH':
+            record["ceiling"] = value
+        elif line_type == 'AL':
+            record["floor"] = value
+        else:
+            raise ValueError(line_type)
+
+
+#
+# Reading of airspace files with an optional cache.
+#
+# If args.cache_dir is set, the parsed records and the resolved
+# coordinates and polygons are stored in a directory per file content
+# and arc options. All arrays are stored as .npy files, which are
+# loaded memory-mapped and without pickle:
+#
+# <cache_dir>/<sha256 of file>/records.json     parsed records
+# <cache_dir>/<sha256 of file>/<arc options>/   resolved records
+#     coords.npy       (M, 2) latitude and longitude of all points
+#     computed.npy     (M,) whether the point was computed from an arc
+#     lineno.npy       (M,) line number of the point or -1
+#     offsets.npy      (N+1,) start of the points of each record
+#     wkb.npy          WKB of all polygons concatenated
+#     wkb_offsets.npy  (N+1,) start of the WKB of each record
+#
+
+CACHE_VERSION = 2
+
+
+def readRecords(filename):
+    """
+    Parse the given OpenAir file.
+
+    @return list of records as returned by aerofiles
+    """
+
+    records = []
+    with open(filename, encoding='latin-1', newline='') as fp:
+        reader = OpenAirReader(fp)
+        for record, error in reader:
+            if error:
+                raise error
+            records.append(record)
+    return records
+
+
+def arcOptions():
+    """
+    @return string describing all options, that influence the
+    resolved coordinates of the records.
+    """
+    global args
+
+    options = f'no_arc={args.no_arc},fast_arc={args.fast_arc}'
+    if arcTolerance() != None:
+        options += f',arc_tolerance={arcTolerance()}'
+    return options
+
+
+def cacheDir(filename):
+    """
+    @return directory of the cache for the content of the given
+    file or None, if no cache is used.
+    """
+    global args
+
+    if not "cache_dir" in args or args.cache_dir == None:
+        return None
+
+    sha256 = hashlib.sha256()
+    sha256.update(f'{CACHE_VERSION}\n'.encode())
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            sha256.update(chunk)
+    return os.path.join(args.cache_dir, sha256.hexdigest())
+
+
+def writeCacheAtomic(dirname, write):
+    """
+    Create the directory dirname by calling write(tmpdir) and
+    renaming the result, so that no half written cache is ever used.
+    """
+    tmpdir = f'{dirname}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(tmpdir)
+        write(tmpdir)
+        os.rename(tmpdir, dirname)
+    except (OSError, TypeError, ValueError) as e:
+        print(f'Unable to write cache {dirname}: {e}', file=sys.stderr)
+        removeDir(tmpdir)
+
+
+def removeDir(dirname):
+    if os.path.isdir(dirname):
+        for name in os.listdir(dirname):
+            os.remove(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
+
+def storeRecords(dirname, records):
+    keys = ["elements_resolved", "polygon"]
+    parsed = [{k: v for k, v in record.items() if not k in keys}
+              for record in records]
+
+    def write(tmpdir):
+        with open(os.path.join(tmpdir, "records.json"), "w") as fp:
+            json.dump(parsed, fp)
+
+    os.makedirs(os.path.dirname(dirname), exist_ok=True)
+    writeCacheAtomic(dirname, write)
+
+
+def loadRecords(dirname):
+    with open(os.path.join(dirname, "records.json")) as fp:
+        return json.load(fp)
+
+
+def storeResolved(dirname, records):
+    """
+    Write the resolved coordinates and the polygons of all records as
+    arrays into the existing directory dirname.
+    """
+    offsets = [0]
+    wkb = []
+    wkb_offsets = [0]
+    for record in records:
+        offsets.append(offsets[-1] + len(record["elements_resolved"]))
+        if "polygon" in record:
+            wkb.append(shapely.to_wkb(record["polygon"]))
+        else:
+            wkb.append(b"")
+        wkb_offsets.append(wkb_offsets[-1] + len(wkb[-1]))
+
+    def concatenate(name, shape, dtype):
+        arrays = [getattr(record["elements_resolved"], name)
+                  for record in records]
+        return np.concatenate([np.empty(shape, dtype=dtype)] + arrays).astype(dtype)
+
+    arrays = {
+        "coords": concatenate("coords", (0, 2), np.float64),
+        "computed": concatenate("computed", 0, bool),
+        "lineno": concatenate("lineno", 0, np.int64),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "wkb": np.frombuffer(b"".join(wkb), dtype=np.uint8),
+        "wkb_offsets": np.array(wkb_offsets, dtype=np.int64),
+    }
+    for (name, array) in arrays.items():
+        np.save(os.path.join(dirname, name + ".npy"), array)
+
+
+def loadResolvedArrays(dirname):
+    """
+    @return list of (Airspace, WKB of the polygon or b"") of all records
+    stored by storeResolved()
+    """
+    def load(name):
+        return np.load(os.path.join(dirname, name + ".npy"), mmap_mode="r", allow_pickle=False)
+
+    coords = load("coords")
+    computed = load("computed")
+    lineno = load("lineno")
+    offsets = load("offsets").tolist()
+    wkb = load("wkb")
+    wkb_offsets = load("wkb_offsets").tolist()
+
+    result = []
+    for i in range(len(offsets) - 1):
+        (start, end) = (offsets[i], offsets[i+1])
+        airspace = Airspace(coords[start:end],
+                            computed[start:end], lineno[start:end])
+        (start, end) = (wkb_offsets[i], wkb_offsets[i+1])
+        result.append((airspace, wkb[start:end].tobytes()))
+    return result
+
+
+def loadResolved(dirname, records):
+    for (record, (airspace, wkb)) in zip(records, loadResolvedArrays(dirname)):
+        record["elements_resolved"] = airspace
+        if len(wkb) > 0:
+            record["polygon"] = shapely.from_wkb(wkb)
+        else:
+            # Report the problem again
+            createPolygonOfRecord(record)
+
+
+def loadAirspace(filename, resolve=True, names=None):
+    """
+    Read the given OpenAir file, resolve all arcs and create the
+    polygons of all records. If args.cache_dir is set, the results are
+    taken from the cache, if the file content and the arc options are
+    unchanged. If the file changed and args.incremental is set, only
+    the changed records are resolved (see resolveIncremental()).
+
+    @param resolve False, if only parsing is needed
+    @param names list of the names (see getAirspaceName2()) of the
+    records to return or None for all. If they are not in the cache,
+    only these records are resolved and only their problems reported.
+
+    @return list of records
+    """
+
+    with profilePhase("cache"):
+        dirname = cacheDir(filename)
+
+    if dirname == None:
+        records = selectRecords(parseRecords(filename), names)
+        if resolve:
+            resolveAndCreatePolygons(records)
+        return records
+
+    if os.path.isdir(dirname):
+        with profilePhase("cache"):
+            records = loadRecords(dirname)
+    else:
+        records = parseRecords(filename)
+        with profilePhase("cache"):
+            storeRecords(dirname, records)
+
+    if resolve:
+        dirname_resolved = os.path.join(dirname, arcOptions())
+        if os.path.isdir(dirname_resolved):
+            with profilePhase("cache"):
+                loadResolved(dirname_resolved, records)
+        elif "incremental" in args and args.incremental:
+            resolveIncremental(records)
+        elif names != None:
+            # The cache holds all records, so the selected ones are
+            # resolved without writing it
+            records = selectRecords(records, names)
+            resolveAndCreatePolygons(records)
+        else:
+            resolveAndCreatePolygons(records)
+            with profilePhase("cache"):
+                writeCacheAtomic(dirname_resolved,
+                                 lambda tmpdir: storeResolved(tmpdir, records))
+
+    return selectRecords(records, names)
+
+
+def selectRecords(records, names):
+    """
+    @return the records with one of the given names or all records,
+    if names is None
+    """
+    if names == None:
+        return records
+    return [record for record in records if getAirspaceName2(record) in names]
+
+
+def parseRecords(filename):
+    with profilePhase("parse"):
+        records = readRecords(filename)
+        profileCount("records", len(records))
+    return records
+
+
+def resolveAndCreatePolygons(records):
+    with profilePhase("resolveRecordArcs"):
+        resolveRecordArcs(records)
+        profileCount("points", sum(len(record["elements_resolved"])
+                                   for record in records))
+    with profilePhase("createPolygons"):
+        createPolygons(records)
+        profileCount("polygons", sum("polygon" in record
+                                     for record in records))
+
+
+#
+# Incremental resolving of changed airspace files.
+#
+# Every record is identified by a key, the hash of its parsed content
+# with all line numbers relative to the first line of the record, so
+# that a record keeps its key, if lines are inserted or removed before
+# it. If args.incremental is set, the resolved records of the last run
+# are stored with their keys and line numbers relative to their record:
+#
+# <cache_dir>/incremental/<arc options>/latest          name of the last run
+# <cache_dir>/incremental/<arc options>/<sha256 of keys>/
+#     keys.json        keys of all records
+#     *.npy            resolved records (see storeResolved())
+#
+
+def recordKeys(records):
+    """
+    Calculate the key of every record and store it as record["key"].
+    Identical records get different keys by appending the number of
+    their occurrence.
+
+    @return list of keys
+    """
+    if all("key" in record for record in records):
+        return [record["key"] for record in records]
+
+    keys = []
+    seen = {}
+    for record in records:
+        base = getAirspaceLine(record) or 0
+        content = {k: v for (k, v) in record.items()
+                   if not k in ["elements", "elements_resolved", "polygon",
+                                "floor_ft", "ceiling_ft", "key"]}
+        content["elements"] = [
+            {k: (v - base if k == "lineno" else v)
+             for (k, v) in element.items()}
+            for element in record["elements"]]
+        text = json.dumps(content, sort_keys=True)
+        key = hashlib.sha256(text.encode()).hexdigest()
+        seen[key] = seen.get(key, 0) + 1
+        record["key"] = f'{key}#{seen[key]}'
+        keys.append(record["key"])
+    return keys
+
+
+def shiftLineno(airspace, offset):
+    """
+    @return copy of the resolved Airspace with all line numbers moved
+    by offset
+    """
+    lineno = np.where(airspace.lineno >= 0, airspace.lineno + offset, -1)
+    return Airspace(airspace.coords, airspace.computed, lineno)
+
+
+def resolveIncremental(records):
+    """
+    Resolve all records, but take the records, that are unchanged since
+    the last run, from the cache.
+
+    @return list of the indices of the records, that were resolved
+    """
+    global args
+
+    dirname = os.path.join(args.cache_dir, "incremental", arcOptions())
+    keys = recordKeys(records)
+
+    previous = {}
+    with profilePhase("cache"):
+        try:
+            with open(os.path.join(dirname, "latest")) as fp:
+                dirname_latest = os.path.join(dirname, fp.read().strip())
+            with open(os.path.join(dirname_latest, "keys.json")) as fp:
+                previous = dict(zip(json.load(fp),
+                                    loadResolvedArrays(dirname_latest)))
+        except (OSError, ValueError):
+            dirname_latest = None
+
+    changed = []
+    for (i, (record, key)) in enumerate(zip(records, keys)):
+        if key in previous and len(previous[key][1]) > 0:
+            (airspace, wkb) = previous[key]
+            record["elements_resolved"] = shiftLineno(
+                airspace, getAirspaceLine(record) or 0)
+            record["polygon"] = shapely.from_wkb(wkb)
+        else:
+            changed.append(i)
+    profileCount("unchanged records", len(records) - len(changed))
+
+    resolveAndCreatePolygons([records[i] for i in changed])
+
+    with profilePhase("cache"):
+        relative = [{"elements_resolved": shiftLineno(record["elements_resolved"],
+                                                      -(getAirspaceLine(record) or 0)),
+                     "polygon": record.get("polygon")}
+                    for record in records]
+        relative = [{k: v for (k, v) in record.items() if v is not None}
+                    for record in relative]
+        name = hashlib.sha256("\n".join(keys).encode()).hexdigest()
+        if dirname_latest != os.path.join(dirname, name):
+            def write(tmpdir):
+                storeResolved(tmpdir, relative)
+                with open(os.path.join(tmpdir, "keys.json"), "w") as fp:
+                    json.dump(keys, fp)
+
+            os.makedirs(dirname, exist_ok=True)
+            if not os.path.isdir(os.path.join(dirname, name)):
+                writeCacheAtomic(os.path.join(dirname, name), write)
+            writeFileAtomic(os.path.join(dirname, "latest"), name + "\n")
+            if dirname_latest != None:
+                removeDir(dirname_latest)
+
+    return changed
+
+
+def writeFileAtomic(filename, content):
+    """
+    Replace the file by the given text, so that no half written file is
+    ever read.
+    """
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, "w") as fp:
+        fp.write(content)
+    os.replace(tmpname, filename)
+
+
+#
+# Profiling of the phases of a program (e.g. check-consistency.py
+# --profile). While common.profiler is set, profilePhase() measures
+# wall time, CPU time and peak memory (by tracemalloc) of a phase and
+# profileCount() counts items in the current phase. Without profiler
+# both do nothing.
+#
+
+profiler = None
+
+
+def profilePhase(name):
+    if profiler == None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+def profileCount(name, n=1):
+    if profiler != None:
+        profiler.count(name, n)
+
+
+class Profiler:
+    """
+    Measure all phases of a program. A phase can be entered several
+    times, the measurements are added up. Phases may be nested, the
+    outer phase then includes the inner one.
+
+    tracemalloc slows down phases allocating many small objects
+    considerably, so measuring the memory can be switched off.
+
+    @param cprofile_phase name of a phase to run under cProfile
+    @param memory False to not measure the peak memory
+    """
+
+    def __init__(self, cprofile_phase=None, memory=True):
+        self.phases = {}
+        self.stack = []
+        self.cprofile_phase = cprofile_phase
+        self.cprofile = cProfile.Profile() if cprofile_phase else None
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        entry = self.phases.setdefault(name, {
+            "name": name, "calls": 0, "wall": 0.0, "cpu": 0.0,
+            "peak_bytes": 0 if self.memory else None, "counts": {}})
+        if self.memory:
+            if self.stack:
+                self.stack[-1]["peak_bytes"] = max(self.stack[-1]["peak_bytes"],
+                                                   tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.stack.append(entry)
+        if name == self.cprofile_phase:
+            self.cprofile.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry["wall"] += time.perf_counter() - wall
+            entry["cpu"] += time.process_time() - cpu
+            entry["calls"] += 1
+            if name == self.cprofile_phase:
+                self.cprofile.disable()
+            self.stack.pop()
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                entry["peak_bytes"] = max(entry["peak_bytes"], peak)
+                if self.stack:
+                    self.stack[-1]["peak_bytes"] = max(
+                        self.stack[-1]["peak_bytes"], peak)
+                tracemalloc.reset_peak()
+
+    def count(self, name, n=1):
+        if self.stack:
+            counts = self.stack[-1]["counts"]
+            counts[name] = counts.get(name, 0) + n
+
+    def result(self):
+        """
+        @return dict with the list of all phases and the totals
+        """
+        peak = None
+        if self.memory:
+            peak = max([tracemalloc.get_traced_memory()[1]] +
+                       [phase["peak_bytes"] for phase in self.phases.values()])
+        return {
+            "phases": list(self.phases.values()),
+            "total": {
+                "wall": time.perf_counter() - self.wall_start,
+                "cpu": time.process_time() - self.cpu_start,
+                "peak_bytes": peak,
+            },
+        }
+
+    def printTable(self, file=sys.stderr):
+        def strPeak(peak_bytes):
+            if peak_bytes == None:
+                return f'{"-":>8}'
+            return f'{peak_bytes / 1e6:8.1f}'
+
+        result = self.result()
+        width = max([len(phase["name"]) for phase in result["phases"]] + [5])
+        print(f'{"phase":{width}} {"wall s":>8} {"cpu s":>8} '
+              f'{"peak MB":>8}  counts', file=file)
+        for phase in result["phases"]:
+            counts = " ".join(f'{k}={v}' for (k, v) in phase["counts"].items())
+            print(f'{phase["name"]:{width}} {phase["wall"]:8.3f} {phase["cpu"]:8.3f} '
+                  f'{strPeak(phase["peak_bytes"])}  {counts}', file=file)
+        total = result["total"]
+        print(f'{"total":{width}} {total["wall"]:8.3f} {total["cpu"]:8.3f} '
+              f'{strPeak(total["peak_bytes"])}', file=file)
+
+    def writeJSON(self, filename, **info):
+        """
+        Write the result() and the given additional info as JSON.
+        """
+        with open(filename, "w") as fp:
+            json.dump(dict(info, **self.result()), fp, indent=1)
+            fp.write("\n")
+
+    def dumpCProfile(self, filename):
+        if self.cprofile != None:
+            self.cprofile.dump_stats(filename)
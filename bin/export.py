@@ -0,0 +1,493 @@
+#!/usr/bin/python # -*- mode: python; python-indent-offset: 4 -*-
+#
+# Export the airspaces of an OpenAir file as GeoJSON Lines (one feature
+# per line) or as FlatGeobuf with a packed Hilbert R-tree index.
+#
+# The records are streamed: every record is parsed, resolved, turned
+# into a polygon and written, before the next one is read. Only the
+# FlatGeobuf writer keeps something per feature, namely its bounding
+# box and its position in a temporary file. This is needed to sort the
+# features and build the index, which are written in front of the
+# features.
+#
+# Every feature has the properties name, class, floor, ceiling,
+# floor_ft and ceiling_ft. Coordinates are written as longitude and
+# latitude (WGS84).
+#
+# The FlatGeobuf encoding follows https://flatgeobuf.org (version 3),
+# the FlatBuffers tables are written directly without the flatbuffers
+# package.
+#
+
+import argparse
+import json
+import shutil
+import struct
+import sys
+import tempfile
+
+import numpy as np
+import shapely
+import shapely.geometry.polygon
+
+import common
+
+PROPERTIES = ["name", "class", "floor", "ceiling", "floor_ft", "ceiling_ft"]
+
+# FlatGeobuf
+FGB_MAGIC = b"fgb\x03fgb\x00"
+FGB_POLYGON = 3
+FGB_COLUMN_DOUBLE = 10
+FGB_COLUMN_STRING = 11
+# Number of children of every node of the index. GDAL reads indexes
+# with this node size only.
+FGB_INDEX_NODE_SIZE = 16
+HILBERT_MAX = (1 << 16) - 1
+
+
+def featureGeometry(record):
+    """
+    @return polygon of the record with longitude as x and latitude as y
+    and the exterior ring counterclockwise (as requested by RFC 7946)
+    """
+    polygon = shapely.transform(record["polygon"],
+                                lambda coords: coords[:, ::-1])
+    return shapely.geometry.polygon.orient(polygon, 1.0)
+
+
+def featureProperties(record):
+    """
+    @return dict of all properties of the feature, missing ones are None
+    """
+    return {key: record.get(key) for key in PROPERTIES}
+
+
+def streamFeatures(filename):
+    """
+    Read the OpenAir file record by record and create the polygon of
+    every record. Problems with heights or polygons are not reported,
+    use check-consistency.py for that.
+
+    @return iterator of (properties, polygon) of all records with a
+    polygon
+    """
+    skipped = 0
+    with open(filename, encoding='latin-1', newline='') as fp:
+        for record, error in common.OpenAirReader(fp):
+            if error:
+                raise error
+            if record["type"] != "airspace":
+                continue
+            with common.collectProblems():
+                common.resolveArcs(record)
+                common.createPolygonOfRecord(record)
+                common.checkHeights([record])
+            if "polygon" not in record:
+                skipped += 1
+                continue
+            yield (featureProperties(record), featureGeometry(record))
+
+    if skipped > 0:
+        print(f'Skipped {skipped} airspaces without a valid polygon',
+              file=sys.stderr)
+
+
+def writeGeoJSONL(features, fp):
+    """
+    Write every feature as one line of GeoJSON.
+
+    @return number of features written
+    """
+    count = 0
+    for (properties, polygon) in features:
+        fp.write(f'{{"type": "Feature", "properties": {json.dumps(properties)}, '
+                 f'"geometry": {shapely.to_geojson(polygon)}}}\n')
+        count += 1
+    return count
+
+
+#
+# FlatBuffers
+#
+# A table is given as list of its fields in the order of the schema
+# (None for absent fields). A field is a tuple (kind, value):
+#
+#   scalar:  ("B", 3), ("H", 16), ("Q", 1234), ("i", -1), ... (struct format)
+#   string:  ("string", "text")
+#   vector:  ("vector", (format, values)) with values as numpy array
+#   table:   ("table", fields)
+#   tables:  ("tables", [fields, ...])
+#
+# All referenced objects are written after the table referencing them,
+# as offsets to them must be unsigned.
+#
+
+
+def _pad(buf, alignment, extra=0):
+    buf.extend(bytes(-(len(buf) + extra) % alignment))
+
+
+def _writeTable(buf, fields):
+    """
+    Append the vtable and the table to buf, followed by all objects
+    referenced by the table.
+
+    @return position of the table in buf
+    """
+
+    # Layout of the inline part: soffset to the vtable, then the
+    # fields sorted by size, so that all are aligned
+    layout = []
+    for (i, field) in enumerate(fields):
+        if field != None:
+            size = struct.calcsize("<" + field[0]) if len(field[0]) == 1 else 4
+            layout.append((size, i))
+    layout.sort(reverse=True)
+    offsets = [0] * len(fields)
+    position = 4
+    for (size, i) in layout:
+        position += -position % size
+        offsets[i] = position
+        position += size
+    table_size = position
+
+    _pad(buf, 2)
+    vtable = len(buf)
+    buf.extend(struct.pack(f'<HH{len(fields)}H', 4 + 2 * len(fields),
+                           table_size, *offsets))
+
+    _pad(buf, 8)
+    table = len(buf)
+    buf.extend(bytes(table_size))
+    struct.pack_into("<i", buf, table, table - vtable)
+
+    for (size, i) in layout:
+        (kind, value) = fields[i]
+        if len(kind) == 1:
+            struct.pack_into("<" + kind, buf, table + offsets[i], value)
+    for (size, i) in layout:
+        (kind, value) = fields[i]
+        if len(kind) > 1:
+            position = _writeObject(buf, kind, value)
+            field = table + offsets[i]
+            struct.pack_into("<I", buf, field, position - field)
+    return table
+
+
+def _writeObject(buf, kind, value):
+    """
+    Append a string, vector, table or vector of tables to buf.
+
+    @return position of the object in buf
+    """
+    if kind == "table":
+        return _writeTable(buf, value)
+    if kind == "string":
+        data = value.encode()
+        _pad(buf, 4)
+        position = len(buf)
+        buf.extend(struct.pack("<I", len(data)) + data + b"\0")
+        return position
+    if kind == "vector":
+        (fmt, values) = value
+        values = np.ascontiguousarray(values, dtype="<" + fmt)
+        _pad(buf, max(values.itemsize, 4), 4)
+        position = len(buf)
+        buf.extend(struct.pack("<I", len(values)))
+        buf.extend(values.tobytes())
+        return position
+    if kind == "tables":
+        _pad(buf, 4)
+        position = len(buf)
+        buf.extend(struct.pack("<I", len(value)))
+        buf.extend(bytes(4 * len(value)))
+        for (i, fields) in enumerate(value):
+            slot = position + 4 + 4 * i
+            struct.pack_into("<I", buf, slot, _writeTable(buf, fields) - slot)
+        return position
+    raise ValueError(f'Unknown kind {kind}')
+
+
+def flatBuffer(fields):
+    """
+    @return size prefixed FlatBuffer with the given root table
+    """
+    buf = bytearray(4)
+    struct.pack_into("<I", buf, 0, _writeTable(buf, fields))
+    _pad(buf, 8)
+    return struct.pack("<I", len(buf)) + bytes(buf)
+
+
+#
+# FlatGeobuf
+#
+
+
+def fgbColumns():
+    columns = []
+    for key in PROPERTIES:
+        if key.endswith("_ft"):
+            column_type = FGB_COLUMN_DOUBLE
+        else:
+            column_type = FGB_COLUMN_STRING
+        # Column: name, type
+        columns.append([("string", key), ("B", column_type)])
+    return columns
+
+
+def fgbHeader(features_count, envelope, index_node_size):
+    # Crs: org, code
+    crs = [("string", "EPSG"), ("i", 4326)]
+    # Header: name, envelope, geometry_type, has_z, has_m, has_t,
+    # has_tm, columns, features_count, index_node_size, crs
+    return flatBuffer([
+        ("string", "airspace"),
+        ("vector", ("d", envelope)),
+        ("B", FGB_POLYGON),
+        None, None, None, None,
+        ("tables", fgbColumns()),
+        ("Q", features_count),
+        ("H", index_node_size),
+        ("table", crs),
+    ])
+
+
+def fgbProperties(properties):
+    """
+    @return properties encoded as FlatGeobuf property buffer: column
+    index followed by the value for every property, that is not None
+    """
+    data = bytearray()
+    for (i, key) in enumerate(PROPERTIES):
+        value = properties[key]
+        if value == None:
+            continue
+        if key.endswith("_ft"):
+            data.extend(struct.pack("<Hd", i, value))
+        else:
+            encoded = value.encode()
+            data.extend(struct.pack("<HI", i, len(encoded)) + encoded)
+    return np.frombuffer(bytes(data), dtype=np.uint8)
+
+
+def fgbFeature(properties, polygon):
+    rings = [polygon.exterior] + list(polygon.interiors)
+    xy = np.concatenate([shapely.get_coordinates(ring) for ring in rings])
+    # Geometry: ends, xy, z, m, t, tm, type
+    geometry = [None, ("vector", ("d", xy.ravel())),
+                None, None, None, None, ("B", FGB_POLYGON)]
+    if len(rings) > 1:
+        ends = np.cumsum([len(ring.coords) for ring in rings])
+        geometry[0] = ("vector", ("I", ends))
+    # Feature: geometry, properties
+    return flatBuffer([("table", geometry), ("vector", ("B", fgbProperties(properties)))])
+
+
+def hilbert(x, y):
+    """
+    @return Hilbert curve index of the uint32 arrays x and y (both in
+    the range 0..HILBERT_MAX), as used by the FlatGeobuf reference
+    implementation
+    """
+    x = x.astype(np.uint32)
+    y = y.astype(np.uint32)
+
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    for shift in [2, 4]:
+        (a, b, c, d) = (A, B, C, D)
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+
+    (a, b, c, d) = (A, B, C, D)
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    def interleave(i):
+        i = (i | (i << 8)) & 0x00FF00FF
+        i = (i | (i << 4)) & 0x0F0F0F0F
+        i = (i | (i << 2)) & 0x33333333
+        return (i | (i << 1)) & 0x55555555
+
+    return (interleave(i1) << 1) | interleave(i0)
+
+
+def hilbertOrder(bounds, envelope):
+    """
+    @return order of the features sorted by the Hilbert index of the
+    centers of their bounds
+    """
+    (min_x, min_y, max_x, max_y) = envelope
+    center = np.column_stack(((bounds[:, 0] + bounds[:, 2]) / 2,
+                              (bounds[:, 1] + bounds[:, 3]) / 2))
+    scaled = []
+    for (axis, low, high) in [(0, min_x, max_x), (1, min_y, max_y)]:
+        if high > low:
+            position = (center[:, axis] - low) / (high - low)
+            scaled.append(np.floor(HILBERT_MAX * position))
+        else:
+            scaled.append(np.zeros(len(bounds)))
+    return np.argsort(hilbert(*scaled), kind="stable")
+
+
+def packedRTree(bounds, offsets, node_size):
+    """
+    Build the packed R-tree over the features, that are already sorted.
+
+    @param bounds array (N, 4) of the bounds of the features
+    @param offsets array (N,) of the byte offsets of the features
+    @param node_size number of children of every node
+
+    @return index as bytes, the root node first and the leaves last
+    """
+    level_sizes = [len(bounds)]
+    n = len(bounds)
+    while True:
+        n = (n + node_size - 1) // node_size
+        level_sizes.append(n)
+        if n == 1:
+            break
+    num_nodes = sum(level_sizes)
+
+    # Start of every level, the leaves are at the end
+    level_starts = []
+    n = num_nodes
+    for size in level_sizes:
+        n -= size
+        level_starts.append(n)
+
+    node_bounds = np.empty((num_nodes, 4))
+    node_offsets = np.empty(num_nodes, dtype=np.uint64)
+    leaves = level_starts[0]
+    node_bounds[leaves:] = bounds
+    node_offsets[leaves:] = offsets
+
+    for level in range(len(level_sizes) - 1):
+        start = level_starts[level]
+        children = node_bounds[start:start + level_sizes[level]]
+        parents = level_starts[level + 1]
+        firsts = np.arange(0, len(children), node_size)
+        end = parents + len(firsts)
+        node_bounds[parents:end, 0:2] = np.minimum.reduceat(children[:, 0:2],
+                                                            firsts)
+        node_bounds[parents:end, 2:4] = np.maximum.reduceat(children[:, 2:4],
+                                                            firsts)
+        node_offsets[parents:end] = start + firsts
+
+    node_item = [("bounds", "<f8", 4), ("offset", "<u8")]
+    nodes = np.empty(num_nodes, dtype=node_item)
+    nodes["bounds"] = node_bounds
+    nodes["offset"] = node_offsets
+    return nodes.tobytes()
+
+
+def writeFlatGeobuf(features, fp, index_node_size):
+    """
+    Write all features as FlatGeobuf. The encoded features are first
+    written into a temporary file, as the header and the index must
+    be written before them.
+
+    @param index_node_size number of children of every node of the
+    index or 0 for no index
+
+    @return number of features written
+    """
+    with tempfile.TemporaryFile() as tmp:
+        bounds = []
+        sizes = []
+        for (properties, polygon) in features:
+            feature = fgbFeature(properties, polygon)
+            tmp.write(feature)
+            sizes.append(len(feature))
+            bounds.append(polygon.bounds)
+
+        count = len(sizes)
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        sizes = np.array(sizes, dtype=np.uint64)
+        starts = np.cumsum(sizes) - sizes
+        if count > 0:
+            envelope = [bounds[:, 0].min(), bounds[:, 1].min(),
+                        bounds[:, 2].max(), bounds[:, 3].max()]
+        else:
+            envelope = []
+            index_node_size = 0
+
+        fp.write(FGB_MAGIC)
+        fp.write(fgbHeader(count, envelope, index_node_size))
+
+        if index_node_size == 0:
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, fp)
+            return count
+
+        order = hilbertOrder(bounds, envelope)
+        sorted_sizes = sizes[order]
+        fp.write(packedRTree(bounds[order], np.cumsum(sorted_sizes) - sorted_sizes,
+                             index_node_size))
+        for (start, size) in zip(starts[order].tolist(), sorted_sizes.tolist()):
+            tmp.seek(start)
+            fp.write(tmp.read(size))
+    return count
+
+
+def main():
+    global args
+
+    parser = argparse.ArgumentParser(
+        description='Export an OpenAir file as GeoJSON Lines or FlatGeobuf')
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output file (- for stdout with GeoJSON Lines)")
+    parser.add_argument("--format", choices=["geojsonl", "fgb"],
+                        help="Output format (default: fgb for *.fgb, otherwise geojsonl)")
+    parser.add_argument("--no-index", action="store_true",
+                        help="Write FlatGeobuf without spatial index and keep the order of the file")
+    parser.add_argument("-n", "--no-arc", action="store_true",
+                        help="Resolve arcs as straight line")
+    parser.add_argument("-f", "--fast-arc", action="store_true",
+                        help="Resolve arcs with less quality (10 degree steps)")
+    parser.add_argument("--arc-tolerance", type=float, metavar="METERS",
+                        help="Resolve arcs with steps, that deviate at most METERS from the arc, instead of fixed steps")
+    parser.add_argument("filename",
+                        help="OpenAir file")
+    args = parser.parse_args()
+    common.setArgs(args)
+
+    output_format = args.format
+    if output_format == None:
+        output_format = "fgb" if args.output.endswith(".fgb") else "geojsonl"
+    if output_format == "fgb" and args.output == "-":
+        parser.error("FlatGeobuf can not be written to stdout")
+
+    features = streamFeatures(args.filename)
+    if output_format == "fgb":
+        with open(args.output, "wb") as fp:
+            count = writeFlatGeobuf(features, fp,
+                                    0 if args.no_index else FGB_INDEX_NODE_SIZE)
+    elif args.output == "-":
+        count = writeGeoJSONL(features, sys.stdout)
+    else:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            count = writeGeoJSONL(features, fp)
+
+    print(f'Exported {count} airspaces to {args.output}', file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,23 @@
 #!/usr/bin/python # -*- mode: python; python-indent-offset: 4 -*-
 
 import argparse
-import io
-
-import aerofiles.openair
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
 
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.style as mplstyle
 from matplotlib.backend_bases import MouseButton
+from matplotlib.collections import LineCollection
 from matplotlib.backends.backend_pdf import PdfPages
 from shapely.geometry import Polygon, LineString, Point
 from shapely.validation import explain_validity
 import shapely
 import sys
+import numpy as np
 
 from icecream import ic
 
@@ -27,43 +31,139 @@ def plot_p(plt, p, color="black"):
     plt.plot(p[1], p[0], '.', color=color)
 
 
-def plot_line(plt, x1, y1, x2, y2, color="black", linewidth=0.5):
-    x = [x1, x2]
-    y = [y1, y2]
-    line, = plt.plot(x, y, color=color, alpha=1.0, linewidth=linewidth)
-    # print(f'plot_line(x1={x1}, y1={y1}, x2={x2}, y2={y2})')
-    return line
-
-
-last_pos = None
 plot_records = []
-
-
-def plot_reset():
-    global last_pos
-
-    last_pos = None
-
-
-def plot_to(plt, pos, color="black", label=True, linewidth=0.5):
-    global last_pos
-    global args
-    line = None
-
-    # print(f'plot_to({common.strLatLon(pos)}')
-    if last_pos != None:
-        line = plot_line(
-            plt, last_pos[1], last_pos[0], pos[1], pos[0], color, linewidth)
-        # print(f'plot_to({common.strLatLon(last_pos)} -> {common.strLatLon(pos)}')
-    last_pos = pos
-    if label and args.show_coords:
-        plt.annotate(common.strLatLon(pos), (pos[1], pos[0]), color=color)
-    return line
+airspace_index = None
+collection = None
+
+# Level of detail: tolerances in degrees of the simplified outlines, the
+# first level has all points. The level, whose tolerance is just below
+# the size of a pixel, is drawn.
+LOD_TOLERANCES = [0, 0.0005, 0.002, 0.008, 0.03]
+lod = None
+
+
+def ring_levels(records):
+    """
+    Compute the segments of the closed rings of all records in plot
+    coordinates (longitude, latitude) for every level of detail.
+
+    @return list with (segments, offsets) for every entry of
+    LOD_TOLERANCES. segments has the shape (M, 2, 2) and the segments
+    of record i are segments[offsets[i]:offsets[i+1]].
+    """
+    lines = []
+    for record in records:
+        xy = record["elements_resolved"].coords[:, ::-1]
+        if len(xy) > 0 and (xy[-1] != xy[0]).any():
+            xy = np.concatenate((xy, xy[:1]))
+        lines.append(shapely.linestrings(xy) if len(xy) >= 2 else None)
+    lines = np.array(lines, dtype=object)
+
+    levels = []
+    for tolerance in LOD_TOLERANCES:
+        simplified = (shapely.simplify(lines, tolerance) if tolerance > 0
+                      else lines)
+        (xy, index) = shapely.get_coordinates(simplified, return_index=True)
+        same = index[1:] == index[:-1]
+        segments = np.stack((xy[:-1], xy[1:]), axis=1)[same]
+        offsets = np.searchsorted(index[:-1][same],
+                                  np.arange(len(records) + 1))
+        levels.append((segments, offsets))
+    return levels
+
+
+def update_lod(ax):
+    """
+    Put the segments of all records visible within the limits of ax into
+    the collection, using the level of detail matching the size of a
+    pixel (or lod["level"] if set). Called whenever the limits of ax
+    change.
+    """
+
+    (x0, x1) = sorted(ax.get_xlim())
+    (y0, y1) = sorted(ax.get_ylim())
+    level = lod["level"]
+    if level == None:
+        pixel = max((x1 - x0) / max(ax.bbox.width, 1),
+                    (y1 - y0) / max(ax.bbox.height, 1))
+        level = max(l for (l, tolerance) in enumerate(LOD_TOLERANCES)
+                    if tolerance <= pixel)
+
+    bboxes = lod["bboxes"]
+    visible = np.flatnonzero((bboxes[:, 0] <= x1) & (bboxes[:, 2] >= x0) &
+                             (bboxes[:, 1] <= y1) & (bboxes[:, 3] >= y0))
+    shown = (level, visible.tobytes())
+    if shown == lod["shown"]:
+        return
+    lod["shown"] = shown
+
+    (segments, offsets) = lod["levels"][level]
+    count = offsets[visible + 1] - offsets[visible]
+    start = np.cumsum(count) - count
+    take = np.repeat(offsets[visible] - start, count) + np.arange(count.sum())
+
+    collection.set_segments(segments[take])
+    collection.set_color(np.repeat(lod["colors"][visible], count, axis=0))
+    collection.set_linewidths(np.repeat(lod["linewidths"][visible], count))
+
+
+def plot_airspaces(ax, records, colors, record_linewidths):
+    """
+    Draw the outlines of all records as one LineCollection.
+
+    Only the records within the limits of ax are put into the collection
+    and their outlines are simplified to the size of a pixel (see
+    update_lod()). The index of every record is stored in
+    record["plot_index"], so that highlight_record() is able to draw
+    single records.
+    """
+    global collection
+    global lod
+
+    bboxes = np.empty((len(records), 4))
+    for (i, (record, color)) in enumerate(zip(records, colors)):
+        record["plot_index"] = i
+        coords = record["elements_resolved"].coords
+        if len(coords) > 0:
+            bboxes[i, :2] = coords.min(axis=0)[::-1]
+            bboxes[i, 2:] = coords.max(axis=0)[::-1]
+        else:
+            bboxes[i] = (np.inf, np.inf, -np.inf, -np.inf)
+
+        if args.show_coords:
+            airspace = record["elements_resolved"]
+            for location in airspace.coords[~airspace.computed].tolist():
+                plt.annotate(common.strLatLon(location),
+                             (location[1], location[0]), color=color)
+
+    lod = {
+        "levels": ring_levels(records),
+        "bboxes": bboxes,
+        "colors": np.array([matplotlib.colors.to_rgba(color) for color in colors]).reshape(-1, 4),
+        "linewidths": np.array(record_linewidths, dtype=float),
+        "level": None,
+        "shown": None,
+    }
+
+    collection = LineCollection(np.empty((0, 2, 2)))
+    ax.add_collection(collection, autolim=False)
+    drawn = np.isfinite(bboxes).all(axis=1)
+    if drawn.any():
+        ax.update_datalim([bboxes[drawn, :2].min(axis=0),
+                           bboxes[drawn, 2:].max(axis=0)])
+    ax.autoscale_view()
+    update_lod(ax)
+    ax.callbacks.connect("xlim_changed", update_lod)
+    ax.callbacks.connect("ylim_changed", update_lod)
+    return collection
 
 
 ax = None
 fig = None
 zoom = 1
+highlight = None
+selected_record = None
+background = None
 
 
 def plot_shapely(plt, shape):
@@ -81,91 +181,100 @@ def plot_shapely(plt, shape):
         print(type(shape))
 
 
+def plot_intersections(overlap):
+    for r1, r2 in overlap:
+        intersection = shapely.intersection(r1["polygon"], r2["polygon"])
+        # 1 degree is approx. 110km.
+        # We define a maximum area for intersection. If bigger, then ignore
+        area_max = 1/110 * 1/110
+        if intersection.area < area_max:
+            plot_shapely(plt, intersection)
+        continue
+
+        if isinstance(intersection, shapely.MultiPolygon) or isinstance(intersection, shapely.GeometryCollection):
+            for polygon in intersection.geoms:
+                x, y = polygon.exterior.xy
+                plt.plot(x, y, color="red")
+                plt.fill(x, y, alpha=0.5, color="red")
+        elif isinstance(intersection, shapely.LineString):
+            plt.plot(*intersection.xy)
+        else:
+            x, y = intersection.exterior.xy
+            plt.plot(x, y, color="red")
+            plt.fill(x, y, alpha=0.5, color="red")
+
+
+def record_styles(records, overlap):
+    """
+    Compute the color and the line width of every record.
+
+    @return (colors, linewidths) as lists with one entry per record
+    """
+    color_num = 30
+    cmap = matplotlib.colormaps['hsv'].resampled(color_num)
+    color_pos = 25
+
+    overlapping = set()
+    for r1, r2 in overlap:
+        overlapping.add(id(r1))
+        overlapping.add(id(r2))
+
+    colors = []
+    record_linewidths = []
+    for record in records:
+        if args.intersects:
+            color = "black"
+            if id(record) in overlapping:
+                color = "blue"
+        else:
+            color = cmap(color_pos)
+            color_pos = (color_pos + 7) % color_num
+
+        if "color" in record:
+            color = record["color"]
+        linewidth = 0.5
+        if "selected" in record:
+            if record["selected"]:
+                print("SELECTED")
+                linewidth = 4
+        colors.append(color)
+        record_linewidths.append(linewidth)
+    return (colors, record_linewidths)
+
+
 def plot(records, overlap):
     global args
     global ax
     global fig
     global plot_records
+    global airspace_index
+    global highlight
+    global selected_record
+    global background
 
     plot_records = records
+    airspace_index = None
 
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
 
     a, = plt.plot([], [])
 
-    color_num = 30
-    cmap = plt.cm.get_cmap('hsv', color_num)
-    color_pos = 25
-
-    plot_reset()
-
     if args.intersects:
-        for r1, r2 in overlap:
-            intersection = shapely.intersection(r1["polygon"], r2["polygon"])
-            # 1 degree is approx. 110km.
-            # We define a maximum area for intersection. If bigger, then ignore
-            area_max = 1/110 * 1/110
-            if intersection.area < area_max:
-                plot_shapely(plt, intersection)
-            continue
+        plot_intersections(overlap)
 
-            if isinstance(intersection, shapely.MultiPolygon) or isinstance(intersection, shapely.GeometryCollection):
-                for polygon in intersection.geoms:
-                    x, y = polygon.exterior.xy
-                    plt.plot(x, y, color="red")
-                    plt.fill(x, y, alpha=0.5, color="red")
-            elif isinstance(intersection, shapely.LineString):
-                plt.plot(*intersection.xy)
-            else:
-                x, y = intersection.exterior.xy
-                plt.plot(x, y, color="red")
-                plt.fill(x, y, alpha=0.5, color="red")
+    (colors, record_linewidths) = record_styles(records, overlap)
+    plot_airspaces(ax, records, colors, record_linewidths)
 
-    if True:
-        for record in records:
-            plot_reset()
-            if args.intersects:
-                color = "black"
-                for r1, r2 in overlap:
-                    if record == r1 or record == r2:
-                        color = "blue"
-                        break
-            else:
-                color = cmap(color_pos)
-                color_pos = (color_pos + 7) % color_num
-
-            if "color" in record:
-                color = record["color"]
-            linewidth = 0.5
-            if "selected" in record:
-                if record["selected"]:
-                    print("SELECTED")
-                    linewidth = 4
-
-            first_pos = None
-            lines = []
-            for element in record["elements_resolved"]:
-                if element["type"] == "point":
-                    if first_pos == None:
-                        first_pos = element["location"]
-                    label = not (
-                        "computed" in element and element["computed"] == True)
-                    line = plot_to(
-                        plt, element["location"], color, label, linewidth)
-                    if line != None:
-                        lines.append(line)
-                else:
-                    print(f'Unknown element type: {element["type"]}')
-                    sys.exit(1)
-
-            if last_pos != first_pos:
-                line = plot_to(plt, first_pos, color, False, linewidth)
-                if line != None:
-                    lines.append(line)
-            record["lines"] = lines
-
-    if last_pos != None:
+    # The record selected by on_keypress() is drawn by blitting on top
+    highlight = LineCollection(np.empty((0, 2, 2)), linewidths=4,
+                               animated=fig.canvas.supports_blit)
+    ax.add_collection(highlight, autolim=False)
+    selected_record = None
+    background = None
+
+    if len(records) > 0 and len(records[-1]["elements_resolved"]) > 0:
+        last_pos = records[-1]["elements_resolved"].coords[0].tolist()
         (dx, _) = common.geo_distance(
             last_pos[1], last_pos[0], last_pos[1] + 1, last_pos[0] + 0)
         (dy, _) = common.geo_distance(
@@ -187,35 +296,32 @@ def plot(records, overlap):
     # fig.canvas.mpl_connect('pick_event', on_press)
     fig.canvas.mpl_connect('key_press_event', on_keypress)
     fig.canvas.mpl_connect('motion_notify_event', on_move)
+    fig.canvas.mpl_connect('draw_event', on_draw)
     fig.canvas.manager.set_window_title("+".join(args.filename))
 
     # with PdfPages('test.pdf') as pdf:
     #    pdf.savefig()
 
+    # The files keep all points
+    lod["level"] = 0
+    update_lod(ax)
     plt.savefig("test.pdf")
     plt.savefig("test.svg", bbox_inches="tight")
+    lod["level"] = None
+    update_lod(ax)
 
     # ax.margins(x=8.877760411607648,y=48.773972056413555)
     plt.show()
 
 
 def find_under(latLon):
+    global airspace_index
 
     print(f'Searching for {latLon}')
 
-    r = []
-    has_ft = True
-    point = Point(latLon[0], latLon[1])
-    for record in plot_records:
-        if "polygon" in record:
-            if record["polygon"].contains(point):
-                r.append(record)
-                if not "floor_ft" in record:
-                    has_ft = False
-
-    if has_ft:
-        r.sort(reverse=False, key=lambda x: x["floor_ft"])
-    return r
+    if airspace_index == None:
+        airspace_index = common.AirspaceIndex(plot_records)
+    return airspace_index.find(latLon[0], latLon[1])
 
 
 def print_under(latLon):
@@ -257,18 +363,52 @@ def on_press(event):
     fig.canvas.draw()
 
 
-def set_linewidth(record, linewidth):
-    for line in record["lines"]:
-        line.set_linewidth(linewidth)
+def highlight_record(record):
+    """
+    Show the given record (or nothing if None) in the highlight
+    collection, using the level of detail currently drawn.
+    """
+    if record == None:
+        highlight.set_segments(np.empty((0, 2, 2)))
+        return
+    (level, _) = lod["shown"]
+    (segments, offsets) = lod["levels"][level]
+    i = record["plot_index"]
+    highlight.set_segments(segments[offsets[i]:offsets[i + 1]])
+    highlight.set_color(lod["colors"][i])
+
+
+def on_draw(event):
+    """
+    After every full redraw: remember the figure without the highlight
+    as background for blitting and draw the highlight on top.
+    """
+    global background
+
+    if not highlight.get_animated() or not event.canvas.supports_blit:
+        return
+    highlight_record(selected_record)
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    ax.draw_artist(highlight)
+
+
+def draw_highlight():
+    """
+    Redraw only the highlight over the cached background.
+    """
+    if background == None:
+        fig.canvas.draw_idle()
+        return
+    fig.canvas.restore_region(background)
+    ax.draw_artist(highlight)
+    fig.canvas.blit(fig.bbox)
 
 
 def on_keypress(event):
     global mousex, mousey, mousez
+    global selected_record
 
     r = find_under([mousey, mousex])
-    for record in plot_records:
-        record["selected"] = False
-        set_linewidth(record, 0.5)
 
     if event.key == 'x':
         print_under([mousey, mousex])
@@ -282,48 +422,38 @@ def on_keypress(event):
     if mousez >= len(r):
         mousez = len(r) - 1
 
-    record = r[mousez]
-    record["selected"] = True
+    if len(r) == 0:
+        return
+
+    # Only the previous and the new selection change
+    if selected_record != None:
+        selected_record["selected"] = False
+    selected_record = r[mousez]
+    selected_record["selected"] = True
 
     i = len(r)
     for record in reversed(r):
-        if record["selected"]:
+        if record is selected_record:
             print(f'[{i}] * {common.getAirspaceName2(record)}')
-            set_linewidth(record, 4)
         else:
             print(f'[{i}]   {common.getAirspaceName2(record)}')
-            set_linewidth(record, 0.5)
         i -= 1
 
-    plt.draw()
+    highlight_record(selected_record)
+    draw_highlight()
 
 
 def airspace_readfile(filename):
     global args
 
     print("Reading openair file", filename)
-    # read file into a StringIO, as we have to parse it multiple times
-    content = io.StringIO()
-    with open(filename, encoding='latin-1', newline='') as fp:
-        content.write(fp.read())
-
-    content.seek(0, io.SEEK_SET)
-    reader = aerofiles.openair.Reader(content)
-
     records = []
-    for record, error in reader:
-        if error:
-            raise error
-        if args.only:
-            if common.getAirspaceName2(record) in args.only:
-                # print("Read ", common.getAirspaceName2(record))
-                records.append(record)
-        else:
+    # Only the selected airspaces are resolved and checked
+    for record in common.loadAirspace(filename, names=args.only):
+        if not args.only:
             print(f'Read "{common.getAirspaceName2(record)}"')
-            records.append(record)
+        records.append(record)
 
-    common.resolveRecordArcs(records)
-    common.createPolygons(records)
     common.checkHeights(records)
     # records = airspace_find_low(records)
     return records
@@ -352,31 +482,6 @@ def airspace_find_pt(record, element_searched):
     return None
 
 
-def jaccard_similarity(poly1, poly2):
-    intersection = poly1.intersection(poly2).area
-    union = poly1.union(poly2).area
-    return intersection / union if union > 0 else 0
-
-# How similar is record2 to record1?
-# 0-100%
-
-
-def airspace_similar_shapely(record1, record2):
-    p1 = record1["polygon"]
-    p2 = record2["polygon"]
-    if not p1.is_valid:
-        # print("Ignoring", common.getAirspaceName2(record1), "because invalid")
-        return 0
-    if not p2.is_valid:
-        # print("Ignoring", common.getAirspaceName2(record2), "because invalid")
-        return 0
-
-    if p1.equals(p2):
-        return 100
-    else:
-        jaccard = jaccard_similarity(p1, p2)
-        return jaccard * 100
-
 # How similar is record2 to record1?
 # 0-100%
 
@@ -416,20 +521,184 @@ def airspace_similar(record1, record2):
     return 100*identical/(e1_count+e2_count)
 
 
-def airspace_find_similar(record1, records2):
-    best_simular = 0
-    best_simular_r2 = None
-    for record2 in records2:
-        simular = airspace_similar_shapely(record1, record2)
-        if simular > best_simular:
-            best_simular = simular
-            best_simular_r2 = record2
-    return (best_simular, best_simular_r2)
+#
+# Headless rendering (--output-dir).
+#
+# The overview (zoom level 0) and the tiles of higher zoom levels are
+# rendered with the Agg backend into <output-dir>/<zoom>/<x>_<y>.<format>,
+# where tile 0_0 is the north west corner. Zoom level N has 2^N x 2^N
+# tiles. The content hash of every tile is stored in
+# <output-dir>/manifest.json and tiles with an unchanged hash are not
+# rendered again.
+#
+
+RENDER_VERSION = 2
+tile_state = None
+
+
+def tile_bounds(bounds, zoom, x, y):
+    """
+    @return (lon_min, lat_min, lon_max, lat_max) of the given tile
+    """
+    (lon_min, lat_min, lon_max, lat_max) = bounds
+    n = 2 ** zoom
+    width = (lon_max - lon_min) / n
+    height = (lat_max - lat_min) / n
+    return (lon_min + x * width, lat_max - (y + 1) * height,
+            lon_min + (x + 1) * width, lat_max - y * height)
+
+
+def tile_content(bounds):
+    """
+    @return (indices of the records, indices of the intersections) to
+    be drawn in a tile with the given bounds
+    """
+    (lon_min, lat_min, lon_max, lat_max) = bounds
+
+    def visible(bboxes):
+        return np.flatnonzero((bboxes[:, 0] <= lon_max) & (bboxes[:, 2] >= lon_min) &
+                              (bboxes[:, 1] <= lat_max) & (bboxes[:, 3] >= lat_min))
+
+    return (visible(tile_state["bboxes"]), visible(tile_state["overlay_bboxes"]))
+
+
+def tile_hash(bounds):
+    sha256 = hashlib.sha256()
+    sha256.update(repr((RENDER_VERSION, bounds, args.format, args.dpi,
+                        args.show_coords)).encode())
+    (selected, overlay) = tile_content(bounds)
+    for i in selected.tolist():
+        coords = tile_state["records"][i]["elements_resolved"].coords
+        sha256.update(coords.tobytes())
+        style = (tile_state["colors"][i], tile_state["linewidths"][i])
+        sha256.update(repr(style).encode())
+    for i in overlay.tolist():
+        sha256.update(shapely.to_wkb(tile_state["overlay"][i]))
+    return sha256.hexdigest()
+
+
+def render_tile(name, zoom, bounds, filename):
+    """
+    Render one tile into filename. Only records and intersections with
+    a bounding box inside the tile are drawn.
+    """
+    (lon_min, lat_min, lon_max, lat_max) = bounds
+    (selected, overlay) = tile_content(bounds)
+
+    # Same ratio of latitude to longitude as in the interactive plot
+    width = 8
+    ratio = (lat_max - lat_min) / (lon_max - lon_min)
+    height = min(max(width * 1.33 * ratio, 2), 32)
+    fig = plt.figure(figsize=(width, height), dpi=args.dpi)
+    ax = fig.add_subplot(1, 1, 1)
 
+    for i in overlay.tolist():
+        plot_shapely(plt, tile_state["overlay"][i])
+    plot_airspaces(ax, [tile_state["records"][i] for i in selected.tolist()],
+                   [tile_state["colors"][i] for i in selected.tolist()],
+                   [tile_state["linewidths"][i] for i in selected.tolist()])
+    ax.set_xlim(lon_min, lon_max)
+    ax.set_ylim(lat_min, lat_max)
+
+    ax.set_title("Airspace" if zoom == 0 else f'Airspace {name}')
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    fig.savefig(filename, dpi=args.dpi, bbox_inches="tight")
+    plt.close(fig)
+    return filename
+
+
+def render_tiles(records, overlap):
+    """
+    Render all tiles of the zoom levels given by --zoom into
+    --output-dir. The tiles are rendered in parallel by --jobs
+    processes, which get the records by fork().
+    """
+    global tile_state
+
+    records = [record for record in records
+               if len(record["elements_resolved"]) > 0]
+    (colors, record_linewidths) = record_styles(records, overlap)
+
+    overlay = []
+    if args.intersects:
+        # Same selection as plot_intersections()
+        area_max = 1/110 * 1/110
+        for r1, r2 in overlap:
+            intersection = shapely.intersection(r1["polygon"], r2["polygon"])
+            if intersection.area < area_max:
+                overlay.append(intersection)
+
+    bboxes = np.array([np.concatenate((record["elements_resolved"].coords.min(axis=0)[::-1],
+                                       record["elements_resolved"].coords.max(axis=0)[::-1]))
+                       for record in records]).reshape(-1, 4)
+    # Intersections are given as (lat, lon) like the polygons
+    overlay_bboxes = shapely.bounds(np.array(overlay, dtype=object))
+    overlay_bboxes = overlay_bboxes.reshape(-1, 4)[:, [1, 0, 3, 2]]
+
+    tile_state = {
+        "records": records,
+        "colors": [matplotlib.colors.to_rgba(color) for color in colors],
+        "linewidths": record_linewidths,
+        "bboxes": bboxes,
+        "overlay": overlay,
+        "overlay_bboxes": overlay_bboxes,
+    }
+
+    if len(records) == 0:
+        print("Nothing to render")
+        return
+
+    # Area of all records plus a small margin
+    (lon_min, lat_min) = bboxes[:, :2].min(axis=0)
+    (lon_max, lat_max) = bboxes[:, 2:].max(axis=0)
+    margin = max(lon_max - lon_min, lat_max - lat_min) * 0.01
+    bounds = (float(lon_min - margin), float(lat_min - margin),
+              float(lon_max + margin), float(lat_max + margin))
+
+    manifest_name = os.path.join(args.output_dir, "manifest.json")
+    try:
+        with open(manifest_name) as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+
+    todo = []
+    skipped = 0
+    for zoom in sorted(set(args.zoom)):
+        os.makedirs(os.path.join(args.output_dir, str(zoom)), exist_ok=True)
+        for y in range(2 ** zoom):
+            for x in range(2 ** zoom):
+                name = os.path.join(str(zoom), f'{x}_{y}.{args.format}')
+                bounds_tile = tile_bounds(bounds, zoom, x, y)
+                digest = tile_hash(bounds_tile)
+                filename = os.path.join(args.output_dir, name)
+                if manifest.get(name) == digest and os.path.exists(filename):
+                    skipped += 1
+                    continue
+                manifest.pop(name, None)
+                todo.append((name, digest, zoom, bounds_tile, filename))
+
+    if args.jobs > 1 and len(todo) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.jobs,
+                mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = [executor.submit(render_tile, name, zoom, bounds_tile, filename)
+                       for (name, digest, zoom, bounds_tile, filename) in todo]
+            for future in futures:
+                future.result()
+    else:
+        for (name, digest, zoom, bounds_tile, filename) in todo:
+            render_tile(name, zoom, bounds_tile, filename)
+
+    for (name, digest, zoom, bounds_tile, filename) in todo:
+        manifest[name] = digest
+    with open(manifest_name + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(manifest_name + ".tmp", manifest_name)
+
+    print(f'Rendered {len(todo)} tiles, skipped {skipped} unchanged tiles')
 
-# matplotlib.use('Qt5Agg')
-# matplotlib.use('Gtk4Agg')
-matplotlib.use('TkAgg')
 
 parser = argparse.ArgumentParser(description='Plot OpenAir airspace file')
 parser.add_argument("-e", "--errors-only", action="store_true",
@@ -446,10 +715,36 @@ parser.add_argument("-i", "--intersects", action="store_true",
                     help="Show intersection between airspaces")
 parser.add_argument("-d", "--diff",
                     help="Show difference to the given airspace file")
+parser.add_argument("-r", "--report", action="store_true",
+                    help="Only print the difference (see --diff) and do not plot")
+parser.add_argument("--cache-dir",
+                    help="Cache parsed and resolved airspaces in this directory")
+parser.add_argument("--output-dir",
+                    help="Render without a window into this directory (see --zoom)")
+parser.add_argument("-z", "--zoom", type=int, action="append",
+                    help="Zoom level to render with --output-dir, 0 is one overview, N is a grid of 2^N x 2^N tiles (can be given multiple times, default 0)")
+parser.add_argument("--format", choices=["png", "svg", "pdf"], default="png",
+                    help="File format of the rendered tiles (default png)")
+parser.add_argument("--dpi", type=int, default=100,
+                    help="Resolution of the rendered tiles (default 100)")
+parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                    help="Number of tiles rendered in parallel")
 parser.add_argument("filename", nargs="+",
                     help="One or more openair filenames")
 args = parser.parse_args()
 common.setArgs(args)
+if args.report and not args.diff:
+    parser.error("--report needs --diff")
+
+if args.zoom == None:
+    args.zoom = [0]
+
+if args.output_dir:
+    matplotlib.use('Agg')
+elif not args.report:
+    # matplotlib.use('Qt5Agg')
+    # matplotlib.use('Gtk4Agg')
+    matplotlib.use('TkAgg')
 
 overlap = []
 records = []
@@ -459,49 +754,29 @@ for filename in args.filename:
 if args.diff:
     records_1 = airspace_readfile(args.diff)
     ic(len(records_1), len(records))
-    identical = []
-    deleted = []
-    added = []
-    for record1 in records_1:
-        asn = common.getAirspaceName2(record1)
-        # breakpoint()
-        (best_simular, best_simular_r) = airspace_find_similar(record1, records)
-        if best_simular == 100:
-            # They are identical
-            # ic(common.getAirspaceName2(record1), common.getAirspaceName2(best_simular_r))
-            identical.append(record1)
-            best_simular_r["color"] = "grey"
-        elif best_simular > 90:
-            # They are similar but changed
-            best_simular_r["color"] = "orange"
-            record1["color"] = "blue"
-            records.append(record1)
-            if False:
-                try:
-                    print("overlap", asn)
-                    intersection = shapely.intersection(
-                        record1["polygon"], record2["polygon"])
-                    area = intersection.area
-                    if area > 0:
-                        overlap.append([record1, record2])
-                except shapely.errors.GEOSException as e:
-                    problem(Prio.ERR, "Invalid Overlapping Airspaces " +
-                            getAirspaceName2(record1) + ", " + getAirspaceName2(record2), e)
-        else:
-            # Removed
-            record1["color"] = "red"
-            records.append(record1)
-
-    for record2 in records:
-        asn = common.getAirspaceName2(record2)
-        (best_simular, best_simular_r) = airspace_find_similar(record2, records_1)
-        if best_simular < 50:
-            # New entry
-            record2["color"] = "green"
-            records.append(record1)
-    # sys.exit(0)
+    diff = common.diffAirspaces(records_1, records)
+    if args.report:
+        common.printDiff(diff)
+        sys.exit(0)
+
+    for (record1, record2) in diff["identical"]:
+        record2["color"] = "grey"
+    for (record1, record2, similar) in diff["changed"]:
+        # They are similar but changed
+        record2["color"] = "orange"
+        record1["color"] = "blue"
+    for record1 in diff["removed"]:
+        record1["color"] = "red"
+    for record2 in diff["added"]:
+        record2["color"] = "green"
+    records.extend([record1 for (record1, record2, similar)
+                    in diff["changed"]])
+    records.extend(diff["removed"])
 
 if args.intersects:
     overlap = common.getOverlappingAirspaces(records)
 
-plot(records, overlap)
+if args.output_dir:
+    render_tiles(records, overlap)
+else:
+    plot(records, overlap)